@@ -0,0 +1,420 @@
+"""
+PersonaFlow 离线基准测试
+
+不需要运行中的 AstrBot：用桩对象代替 Context / AstrMessageEvent /
+ProviderRequest / LLMResponse，用可配置延迟的假 llm_generate 代替大模型，
+回放合成流量或 JSONL 录制的流量，统计各个热点路径的吞吐量和延迟分位数，
+结果以 JSON 输出，便于在不同版本之间对比。
+
+用法:
+    python bench/bench_personaflow.py --users 1000 10000 100000 -o bench.json
+    python bench/bench_personaflow.py --traffic recorded.jsonl --config '{"write_behind_enabled": true}'
+
+JSONL 每行一条消息: {"session_id": "...", "sender_id": "...", "sender_name": "...",
+"message": "...", "reply": "..."}，reply 缺省时使用固定回复。
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+PLUGIN_PACKAGE = "astrbot_plugin_PersonaFlow"
+PERSONA_NAME = "基准人格"
+PERSONA_PROMPT = "你是一个用于基准测试的AI助手。\n\n认识的人:\n{Impression}\n\n请用符合人设的语气回答。"
+
+_DATA_DIR = None  # StarTools.get_data_dir 返回的目录，每个规模单独创建
+
+
+# ************ AstrBot 桩对象 **********
+
+
+class StubEvent:
+    """AstrMessageEvent 的最小实现"""
+
+    def __init__(self, session_id, sender_id, sender_name, message):
+        self._session_id = session_id
+        self._sender_id = sender_id
+        self._sender_name = sender_name
+        self._message = message
+        self.unified_msg_origin = f"bench:GroupMessage:{session_id}"
+
+    def get_session_id(self):
+        return self._session_id
+
+    def get_sender_id(self):
+        return self._sender_id
+
+    def get_sender_name(self):
+        return self._sender_name
+
+    def get_message_str(self):
+        return self._message
+
+    def plain_result(self, text):
+        return text
+
+
+class StubProviderRequest:
+    def __init__(self):
+        self.system_prompt = ""
+
+
+class StubLLMResponse:
+    def __init__(self, completion_text=""):
+        self.completion_text = completion_text
+
+
+class StubPermissionType:
+    ADMIN = "admin"
+    MEMBER = "member"
+
+
+class StubFilter:
+    """filter 装饰器只返回原函数"""
+
+    PermissionType = StubPermissionType
+
+    def permission_type(self, *args, **kwargs):
+        return lambda func: func
+
+    def on_llm_request(self, *args, **kwargs):
+        return lambda func: func
+
+    def on_llm_response(self, *args, **kwargs):
+        return lambda func: func
+
+    def command_group(self, *args, **kwargs):
+        def decorator(func):
+            func.command = lambda *a, **k: (lambda f: f)
+            return func
+
+        return decorator
+
+
+class StubStar:
+    def __init__(self, context):
+        self.context = context
+
+
+class StubStarTools:
+    @staticmethod
+    def get_data_dir(name):
+        return Path(_DATA_DIR)
+
+
+class StubProviderManager:
+    def __init__(self):
+        self.personas = [
+            {"name": PERSONA_NAME, "prompt": PERSONA_PROMPT, "begin_dialogs": [], "tools": []}
+        ]
+
+
+class StubContext:
+    """Context 桩：假 llm_generate 按配置的延迟返回固定的总结 JSON"""
+
+    def __init__(self, llm_latency_ms):
+        self.provider_manager = StubProviderManager()
+        self.llm_latency = llm_latency_ms / 1000
+        self.llm_calls = 0
+
+    async def get_current_chat_provider_id(self, umo=None):
+        return "bench-provider"
+
+    async def llm_generate(self, chat_provider_id=None, prompt="", system_prompt="", **kwargs):
+        self.llm_calls += 1
+        await asyncio.sleep(self.llm_latency)
+        # 合并总结请求返回数组，其余返回单个对象
+        qq_numbers = re.findall(r"qq_number: (\S+?)\)", prompt)
+        if qq_numbers:
+            items = [
+                {"qq_number": q, "relationship": "朋友", "impression": "基准测试用户"}
+                for q in qq_numbers
+            ]
+            return StubLLMResponse(json.dumps(items, ensure_ascii=False))
+        return StubLLMResponse('{"relationship": "朋友", "impression": "基准测试用户"}')
+
+
+def install_stub_astrbot():
+    """注册 astrbot.api.* 桩模块并以包的形式加载插件，返回 main 模块"""
+    logger = logging.getLogger("personaflow.bench")
+    logger.setLevel(logging.WARNING)
+
+    api = types.ModuleType("astrbot.api")
+    api.logger = logger
+    event = types.ModuleType("astrbot.api.event")
+    event.AstrMessageEvent = StubEvent
+    event.filter = StubFilter()
+    provider = types.ModuleType("astrbot.api.provider")
+    provider.LLMResponse = StubLLMResponse
+    provider.ProviderRequest = StubProviderRequest
+    star = types.ModuleType("astrbot.api.star")
+    star.Context = StubContext
+    star.Star = StubStar
+    star.register = lambda *args, **kwargs: (lambda cls: cls)
+    star.StarTools = StubStarTools
+
+    sys.modules["astrbot"] = types.ModuleType("astrbot")
+    sys.modules["astrbot.api"] = api
+    sys.modules["astrbot.api.event"] = event
+    sys.modules["astrbot.api.provider"] = provider
+    sys.modules["astrbot.api.star"] = star
+
+    package_spec = importlib.util.spec_from_file_location(
+        PLUGIN_PACKAGE,
+        PLUGIN_DIR / "__init__.py",
+        submodule_search_locations=[str(PLUGIN_DIR)],
+    )
+    package = importlib.util.module_from_spec(package_spec)
+    sys.modules[PLUGIN_PACKAGE] = package
+
+    spec = importlib.util.spec_from_file_location(
+        f"{PLUGIN_PACKAGE}.main", PLUGIN_DIR / "main.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# ************ 流量 **********
+
+
+def synthetic_traffic(users, messages, sessions, seed):
+    """合成流量：发言者服从长尾分布(少数活跃用户贡献大部分消息)"""
+    rng = random.Random(seed)
+    for i in range(messages):
+        if rng.random() < 0.25:
+            uid = rng.randrange(users)
+        else:
+            uid = min(int(rng.paretovariate(1.2)) - 1, users - 1)
+        yield {
+            "session_id": f"group{uid % sessions}",
+            "sender_id": str(100000 + uid),
+            "sender_name": f"用户{uid}",
+            "message": f"第{i}条消息，随便聊聊今天的天气和晚饭吃什么。",
+            "reply": "好的呀，今天天气不错，晚饭可以吃点清淡的。" * 3,
+        }
+
+
+def recorded_traffic(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+# ************ 统计 **********
+
+
+def summarize(samples):
+    """延迟样本(秒) -> 毫秒统计"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(pct(50), 3),
+        "p99_ms": round(pct(99), 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+async def timed(samples, coro):
+    start = time.perf_counter()
+    result = await coro
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+# ************ 基准 **********
+
+
+async def run_scale(main_module, args, users, work_dir):
+    global _DATA_DIR
+    _DATA_DIR = work_dir
+    db_path = os.path.join(work_dir, "OSNpermemory.db")
+
+    config = {
+        "personas_name": PERSONA_NAME,
+        "summary_trigger_threshold": args.threshold,
+        "summary_history_count": 20,
+        "apply_to_group_chat": [],
+        "database_path": db_path,
+        "summary_max_retries": 3,
+    }
+    config.update(args.plugin_config)
+
+    context = StubContext(args.llm_latency_ms)
+    plugin = main_module.PersonaFlow(context, config)
+
+    if args.traffic:
+        traffic = recorded_traffic(args.traffic)
+    else:
+        messages = args.messages or users * args.messages_per_user
+        traffic = synthetic_traffic(users, messages, args.sessions, args.seed)
+
+    samples = {"inject_dynamic_persona": [], "on_llm_response": []}
+    seen_users = {}
+    wal_peak = 0
+    replayed = 0
+    start = time.perf_counter()
+    for item in traffic:
+        event = StubEvent(
+            item["session_id"], item["sender_id"], item["sender_name"], item["message"]
+        )
+        await timed(
+            samples["inject_dynamic_persona"],
+            plugin.inject_dynamic_persona(event, StubProviderRequest()),
+        )
+        await timed(
+            samples["on_llm_response"],
+            plugin.on_llm_response(event, StubLLMResponse(item.get("reply", "好的。"))),
+        )
+        seen_users[item["sender_id"]] = item["sender_name"]
+        replayed += 1
+        if replayed % 1000 == 0:
+            wal_peak = max(wal_peak, file_size(db_path + "-wal"))
+    elapsed = time.perf_counter() - start
+    wal_peak = max(wal_peak, file_size(db_path + "-wal"))
+
+    # 等后台总结跑完，再单独测量总结和 /osn check
+    await wait_for_summaries(plugin)
+
+    summary_samples = []
+    rng = random.Random(args.seed)
+    for qq_number in rng.sample(sorted(seen_users), min(args.summary_samples, len(seen_users))):
+        await timed(
+            summary_samples,
+            plugin.llm_summary(
+                "bench:GroupMessage:group0", seen_users[qq_number], qq_number, PERSONA_NAME
+            ),
+        )
+
+    check_samples = []
+    check_event = StubEvent("group0", "bench-admin", "管理员", "/osn check")
+    for _ in range(args.check_samples):
+        start_check = time.perf_counter()
+        async for _ in plugin.check_memory(check_event):
+            pass
+        check_samples.append(time.perf_counter() - start_check)
+
+    metrics = plugin.metrics.snapshot() if hasattr(plugin, "metrics") else None
+    await plugin.terminate()
+
+    return {
+        "users": users,
+        "distinct_senders": len(seen_users),
+        "messages": replayed,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_per_s": round(replayed / elapsed, 1) if elapsed else None,
+        "llm_calls": context.llm_calls,
+        "latency": {
+            "inject_dynamic_persona": summarize(samples["inject_dynamic_persona"]),
+            "on_llm_response": summarize(samples["on_llm_response"]),
+            "llm_summary": summarize(summary_samples),
+            "osn_check": summarize(check_samples),
+        },
+        "db_bytes": file_size(db_path),
+        "wal_peak_bytes": wal_peak,
+        "wal_final_bytes": file_size(db_path + "-wal"),
+        "plugin_metrics": metrics,
+    }
+
+
+async def wait_for_summaries(plugin, timeout=300):
+    """等待后台总结队列清空"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = plugin.summary_queue_status()
+        if not status["queued"] and not status["in_flight"]:
+            return
+        await asyncio.sleep(0.05)
+
+
+async def main_async(args):
+    main_module = install_stub_astrbot()
+    results = []
+    scales = [None] if args.traffic else args.users
+    for users in scales:
+        work_dir = tempfile.mkdtemp(prefix="personaflow-bench-")
+        try:
+            result = await run_scale(main_module, args, users, work_dir)
+        finally:
+            if not args.keep_db:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        results.append(result)
+        print(
+            f"users={result['users']} messages={result['messages']} "
+            f"throughput={result['throughput_msg_per_s']} msg/s",
+            file=sys.stderr,
+        )
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "plugin_config": args.plugin_config,
+        "llm_latency_ms": args.llm_latency_ms,
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PersonaFlow 离线基准测试")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="合成流量的用户规模，可给多个")
+    parser.add_argument("--messages-per-user", type=int, default=2,
+                        help="合成流量的消息数 = 用户数 x 该值")
+    parser.add_argument("--messages", type=int, default=0,
+                        help="直接指定合成流量的消息数，覆盖 --messages-per-user")
+    parser.add_argument("--sessions", type=int, default=50, help="合成流量的群聊数")
+    parser.add_argument("--traffic", help="回放 JSONL 录制流量，代替合成流量")
+    parser.add_argument("--threshold", type=int, default=5, help="summary_trigger_threshold")
+    parser.add_argument("--llm-latency-ms", type=float, default=200, help="假 llm_generate 的延迟")
+    parser.add_argument("--summary-samples", type=int, default=20,
+                        help="单独测量 llm_summary 的次数")
+    parser.add_argument("--check-samples", type=int, default=5, help="测量 /osn check 的次数")
+    parser.add_argument("--config", dest="plugin_config", type=json.loads, default={},
+                        help="覆盖插件配置的 JSON，例如 '{\"write_behind_enabled\": true}'")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep-db", action="store_true", help="保留测试数据库目录")
+    parser.add_argument("-o", "--output", help="结果 JSON 文件，默认输出到标准输出")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
-import ast
 import asyncio
+import contextlib
+import functools
+import hashlib
+import itertools
 import json
+import math
 import os
+import random
 import re
-from datetime import datetime
+import time
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from pathlib import Path
 
 import aiosqlite
 
@@ -12,11 +21,823 @@ from astrbot.api.event import AstrMessageEvent, filter
 from astrbot.api.provider import LLMResponse, ProviderRequest
 from astrbot.api.star import Context, Star, register, StarTools
 
+from .memory_io import MODES as IMPORT_MODES
+from .memory_io import export_memories, import_memories
+from .message_codec import CODECS as MESSAGE_CODECS
+from .message_codec import ZSTD_AVAILABLE, decode_message, encode_body, merge_message, split_message
+
 """
 版本0.7.7
-移除动态人格Prompt缓存
+动态人格 Prompt 与印象列表使用进程内缓存：本进程写入时同步更新，
+其他进程的写入由后台轮询 PRAGMA data_version 发现
 """
 
+_UNSET = object()
+
+# 关系强度：按关键词匹配，越靠前优先级越高；都不匹配时取默认值
+RELATIONSHIP_WEIGHTS = (
+    ("恋人", 1.0),
+    ("挚友", 0.9),
+    ("死党", 0.9),
+    ("好友", 0.8),
+    ("朋友", 0.6),
+    ("师生", 0.6),
+    ("同学", 0.5),
+    ("熟人", 0.4),
+    ("陌生人", 0.1),
+)
+DEFAULT_RELATIONSHIP_WEIGHT = 0.3
+
+
+def estimate_tokens(text):
+    """本地粗略估算 token 数：CJK 等宽字符按 1 个计，其余字符每 4 个计 1 个"""
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def relationship_weight(relationship):
+    if not relationship:
+        return 0.0
+    for keyword, weight in RELATIONSHIP_WEIGHTS:
+        if keyword in relationship:
+            return weight
+    return DEFAULT_RELATIONSHIP_WEIGHT
+
+
+def parse_db_time(value):
+    """把 CURRENT_TIMESTAMP 写入的 UTC 时间字符串转为时间戳，无法解析时返回 0"""
+    if not value:
+        return 0.0
+    try:
+        return (
+            datetime.strptime(str(value)[:19], "%Y-%m-%d %H:%M:%S")
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+        )
+    except ValueError:
+        return 0.0
+
+
+def db_time_now():
+    """当前 UTC 时间，格式与 CURRENT_TIMESTAMP 相同"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ************ 大模型 JSON 输出解析 **********
+
+# 全角括号/标点 -> 半角，只在字符串外生效
+FULLWIDTH_PUNCTUATION = {"｛": "{", "｝": "}", "［": "[", "］": "]", "：": ":", "，": ","}
+# 字符串引号 -> 对应的结束引号，兼容单引号和全角引号
+QUOTE_PAIRS = {'"': '"', "'": "'", "“": "”", "‘": "’"}
+BRACKET_PAIRS = {"{": "}", "[": "]"}
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def iter_json_candidates(text):
+    """按出现顺序产出最外层括号配对完整的 {...} / [...] 片段
+
+    只有括号内的双引号才算字符串(闲聊里的 I'm 之类的撇号不影响配对)，字符串内的括号跳过。
+    某个片段括号不配对或直到结尾都没有闭合时，从它的下一个字符重新扫描，不会因此漏掉后面的 JSON。
+    """
+    pos, n = 0, len(text)
+    while pos < n:
+        stack = []
+        start = pos
+        in_string = False
+        escaped = False
+        for i in range(pos, n):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                continue
+            ch = FULLWIDTH_PUNCTUATION.get(ch, ch)
+            if ch in BRACKET_PAIRS:
+                if not stack:
+                    start = i
+                stack.append(BRACKET_PAIRS[ch])
+            elif not stack:
+                continue
+            elif ch == '"':
+                in_string = True
+            elif ch in "}]":
+                if ch != stack.pop():
+                    break
+                if not stack:
+                    yield text[start : i + 1]
+        else:
+            if not stack:
+                return
+        pos = start + 1
+
+
+def repair_json(candidate):
+    """宽松修复：全角标点、单引号/全角引号/无引号字符串、尾随逗号、Python 的 True/False/None"""
+    out = []
+    i, n = 0, len(candidate)
+    while i < n:
+        ch = candidate[i]
+        if ch in QUOTE_PAIRS:
+            # 统一改写为双引号字符串
+            closer = QUOTE_PAIRS[ch]
+            buf = []
+            i += 1
+            while i < n and candidate[i] != closer:
+                c = candidate[i]
+                if c == "\\" and i + 1 < n:
+                    nxt = candidate[i + 1]
+                    buf.append(nxt if nxt == "'" else c + nxt)
+                    i += 2
+                    continue
+                buf.append('\\"' if c == '"' else c)
+                i += 1
+            out.append('"' + "".join(buf) + '"')
+            i += 1
+            continue
+        if ch.isalpha():
+            j = i
+            while j < n and candidate[j].isalnum():
+                j += 1
+            word = candidate[i:j]
+            if word in PYTHON_LITERALS:
+                word = PYTHON_LITERALS[word]
+            elif word not in ("true", "false", "null"):
+                word = json.dumps(word, ensure_ascii=False)  # 没加引号的键或值
+            out.append(word)
+            i = j
+            continue
+        ch = FULLWIDTH_PUNCTUATION.get(ch, ch)
+        if ch in "}]":
+            # 去掉结束括号前的尾随逗号
+            k = len(out) - 1
+            while k >= 0 and out[k].isspace():
+                k -= 1
+            if k >= 0 and out[k] == ",":
+                del out[k]
+        out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def parse_json_payload(text, accept=None):
+    """从大模型输出中取出第一个满足 accept 的 JSON 值
+
+    先整段解析，再依次尝试各候选片段(原样、修复后)。返回 (结果, 是否经过修复)，失败返回 (None, False)。
+    """
+    if not text:
+        return None, False
+    try:
+        value = json.loads(text)
+        if accept is None or accept(value):
+            return value, False
+    except ValueError:
+        pass
+
+    for candidate in iter_json_candidates(text):
+        for repaired in (False, True):
+            try:
+                value = json.loads(repair_json(candidate) if repaired else candidate)
+            except ValueError:
+                continue
+            if accept is None or accept(value):
+                return value, repaired
+            break  # 能解析但不符合结构，修复也无济于事
+    return None, False
+
+
+def is_summary_object(value):
+    """单个总结结果：relationship、impression 都是非空字符串"""
+    return (
+        isinstance(value, dict)
+        and isinstance(value.get("relationship"), str)
+        and bool(value["relationship"])
+        and isinstance(value.get("impression"), str)
+        and bool(value["impression"])
+    )
+
+
+def is_summary_list(value):
+    """合并总结结果：至少包含一个对象的数组，逐条校验由调用方完成"""
+    return isinstance(value, list) and any(isinstance(item, dict) for item in value)
+
+
+class ImpressionBlock:
+    """
+    物化的印象列表：按用户入库顺序保存每个用户渲染好的一行。
+    单个用户的变化只重写这一行，不需要整表查询和重新拼接每一行。
+    """
+
+    HEADER = "已知的人物关系如下：\n"
+    EMPTY = "暂无已知的关系与印象记录。"
+    # 缓存友好布局中，核心块之后的"最近更新"块的标题；同一用户在核心块中的旧行仍保留，以这里为准
+    RECENT_HEADER = "\n最近更新的人物关系(与上文冲突时以此为准)：\n"
+
+    # 排序权重：最近活跃、对话次数、关系强度
+    RECENCY_WEIGHT = 0.5
+    ACTIVITY_WEIGHT = 0.3
+    RELATIONSHIP_WEIGHT = 0.2
+    RECENCY_HALF_LIFE = 7 * 86400  # 活跃度减半的时间(秒)
+
+    def __init__(self, rows=(), recent_limit=0):
+        self._fields = OrderedDict()  # qq_number -> [name, relationship, impression]
+        self._lines = OrderedDict()  # qq_number -> 渲染后的一行，与 _fields 同序
+        # 最近变化过的用户，按变化先后排列；渲染时放在核心块之后，超过 recent_limit 时整体并回核心块
+        self._recent = OrderedDict()
+        # 核心块在上一次合并时冻结的内容，合并前保持不变(旧行不删除)，前缀缓存才能一直命中
+        self._core = OrderedDict()
+        self.recent_limit = 0
+        self._tokens = {}  # qq_number -> 该行的估算 token 数
+        self._stats = {}  # qq_number -> [dialogue_count, 最近活跃时间戳]
+        self._text = None  # render() 的结果缓存
+        self._packed = None  # (budget, 文本) 按预算裁剪后的结果缓存
+        for row in rows:
+            self.upsert(*row[:4])
+            if len(row) > 4:
+                self.touch(row[0], dialogue_count=row[4] or 0, at=parse_db_time(row[5]))
+        # 加载完成后才开始记录变化，初始内容全部属于核心块
+        self.recent_limit = recent_limit
+        if recent_limit > 0:
+            self._core = OrderedDict(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    @staticmethod
+    def format_line(qq_number, name, relationship, impression):
+        """单个用户的印象行，None 字段用默认文本代替"""
+        r_name = name if name is not None else "未知昵称"
+        r_rel = relationship if relationship is not None else "无"
+        r_imp = impression if impression is not None else "无"
+        return f"{r_name}({qq_number})，关系：{r_rel}，印象：{r_imp}。"
+
+    def upsert(self, qq_number, name=_UNSET, relationship=_UNSET, impression=_UNSET):
+        """新增或更新一个用户，未传入的字段保持不变；新用户追加到末尾"""
+        key = str(qq_number)
+        fields = self._fields.get(key)
+        if fields is None:
+            fields = self._fields[key] = [None, None, None]
+        for i, value in enumerate((name, relationship, impression)):
+            if value is not _UNSET:
+                fields[i] = value
+
+        self._stats.setdefault(key, [0, 0.0])
+
+        line = self.format_line(key, *fields)
+        old = self._lines.get(key)
+        if old != line:
+            self._lines[key] = line
+            self._tokens[key] = estimate_tokens(line)
+            self._packed = None
+            if self.recent_limit <= 0:
+                self._text = self._splice(old, line)
+            else:
+                self._text = None
+                self._recent[key] = None
+                self._recent.move_to_end(key)
+                if len(self._recent) > self.recent_limit:
+                    # 攒够一批再并回核心块，核心块每 recent_limit 次变化才改写一次
+                    self._recent.clear()
+                    self._core = OrderedDict(self._lines)
+
+    def update(self, qq_number, **fields):
+        """只更新已有用户，不存在的用户忽略(例如总结进行中该用户已被删除)"""
+        if str(qq_number) in self._fields:
+            self.upsert(qq_number, **fields)
+
+    def _splice(self, old, new):
+        """在已渲染的全文中只替换(或追加)这一行，查找与拼接都在 C 层完成，不逐个用户重新拼接"""
+        text = self._text
+        if text is None:
+            return None
+        if old is None:
+            # 新用户位于入库顺序的末尾
+            return self.HEADER + new if len(self._lines) == 1 else text + "\n" + new
+        # 每一行前面都是换行(包括紧跟 HEADER 的第一行)，后面是换行或文本结尾
+        needle = "\n" + old
+        start = text.find(needle)
+        while start >= 0:
+            end = start + len(needle)
+            if end == len(text) or text[end] == "\n":
+                return text[: start + 1] + new + text[end:]
+            start = text.find(needle, start + 1)
+        return None
+
+    def touch(self, qq_number, dialogue_count=None, at=None):
+        """更新排序用的活跃信息；不传 dialogue_count 时计数 +1，不传 at 时取当前时间"""
+        stats = self._stats.get(str(qq_number))
+        if stats is None:
+            return
+        stats[0] = stats[0] + 1 if dialogue_count is None else dialogue_count
+        stats[1] = time.time() if at is None else at
+        self._packed = None
+
+    def remove(self, qq_number):
+        key = str(qq_number)
+        if self._fields.pop(key, None) is not None:
+            self._lines.pop(key, None)
+            self._tokens.pop(key, None)
+            self._stats.pop(key, None)
+            self._recent.pop(key, None)
+            self._core.pop(key, None)
+            self._text = None
+            self._packed = None
+
+    def lines_for(self, qq_numbers, stable=False):
+        """取出若干用户的印象行，不存在的用户跳过；stable 为真时按入库顺序而不是给定顺序"""
+        if stable:
+            wanted = {str(q) for q in qq_numbers}
+            return [line for key, line in self._lines.items() if key in wanted]
+        return [self._lines[str(q)] for q in qq_numbers if str(q) in self._lines]
+
+    def render(self, token_budget=0):
+        """拼接全部用户的印象文本(结果缓存到下一次变化)；token_budget > 0 时按预算裁剪"""
+        if token_budget > 0 and self._lines:
+            if self._packed is None or self._packed[0] != token_budget:
+                self._packed = (token_budget, self._pack(token_budget))
+            return self._packed[1]
+
+        if self._text is None:
+            self._text = self._join() if self._lines else self.EMPTY
+        return self._text
+
+    def _join(self, chosen=None, omitted=0):
+        """核心块(入库顺序)在前，最近更新块(变化顺序)在后；chosen 为空表示全部用户
+
+        分块时核心块取冻结的内容，最近更新过的用户在核心块中保留旧行，由最近更新块覆盖
+        """
+        lines = self._core if self.recent_limit > 0 else self._lines
+        core = [line for key, line in lines.items() if chosen is None or key in chosen]
+        if omitted:
+            core.append(f"另有{omitted}位认识的人未列出。")
+        text = self.HEADER + "\n".join(core)
+        recent = [self._lines[key] for key in self._recent if chosen is None or key in chosen]
+        if recent:
+            text += self.RECENT_HEADER + "\n".join(recent)
+        return text
+
+    def _rank(self):
+        """按得分从高到低排序的 qq_number 列表；得分相同按 qq_number 排，保证结果确定"""
+        # 以最近一次活跃的用户为基准计算时间衰减，不依赖当前时间，输入相同输出就相同
+        newest = max((s[1] for s in self._stats.values()), default=0.0)
+        max_count = max((s[0] for s in self._stats.values()), default=0)
+        scores = {}
+        for key, fields in self._fields.items():
+            count, active_at = self._stats[key]
+            recency = 0.5 ** ((newest - active_at) / self.RECENCY_HALF_LIFE) if active_at else 0.0
+            activity = math.log1p(count) / math.log1p(max_count) if max_count else 0.0
+            scores[key] = (
+                self.RECENCY_WEIGHT * recency
+                + self.ACTIVITY_WEIGHT * activity
+                + self.RELATIONSHIP_WEIGHT * relationship_weight(fields[1])
+            )
+        return sorted(scores, key=lambda k: (-scores[k], k))
+
+    def _pack(self, token_budget):
+        """按得分挑选能放进预算的用户，输出时保持原有顺序，放不下的汇总为人数"""
+        remaining = token_budget - estimate_tokens(self.HEADER)
+        # 预留汇总行的空间
+        remaining -= estimate_tokens(f"另有{len(self._lines)}位认识的人未列出。")
+        chosen = set()
+        for key in self._rank():
+            cost = self._tokens[key] + 1  # +1 为换行符
+            if key in self._recent and key in self._core:
+                # 核心块中的旧行与最近更新块中的新行都会输出
+                cost += estimate_tokens(self._core[key]) + 1
+            if cost <= remaining:
+                chosen.add(key)
+                remaining -= cost
+
+        return self._join(chosen, len(self._lines) - len(chosen))
+
+
+class UserRegistry:
+    """
+    内存用户表: qq_number -> [name, dialogue_count, last_summarized_count, last_active_at]。
+    超出容量时按 LRU 淘汰；修改过的计数标记为 dirty，由调用方定期批量落库。
+    被淘汰但尚未落库的记录暂存在 _evicted 中，落库前再次访问会直接恢复。
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max(1, max_size)
+        self._users = OrderedDict()
+        self._dirty = set()
+        self._evicted = {}  # 已淘汰但未落库: qq_number -> 与 _users 相同的记录
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, qq_number):
+        key = str(qq_number)
+        entry = self._users.get(key)
+        if entry is not None:
+            self._users.move_to_end(key)
+            return entry
+        entry = self._evicted.pop(key, None)
+        if entry is not None:
+            self._insert(key, entry)
+            self._dirty.add(key)
+        return entry
+
+    def put(self, qq_number, name, dialogue_count, last_summarized_count, last_active_at=None):
+        entry = [name, dialogue_count or 0, last_summarized_count or 0, last_active_at]
+        self._insert(str(qq_number), entry)
+        return entry
+
+    def _insert(self, key, entry):
+        self._users[key] = entry
+        self._users.move_to_end(key)
+        while len(self._users) > self.max_size:
+            old_key, old_entry = self._users.popitem(last=False)
+            if old_key in self._dirty:
+                self._dirty.discard(old_key)
+                self._evicted[old_key] = old_entry
+
+    def mark_dirty(self, qq_number):
+        self._dirty.add(str(qq_number))
+
+    def remove(self, qq_number):
+        key = str(qq_number)
+        self._users.pop(key, None)
+        self._evicted.pop(key, None)
+        self._dirty.discard(key)
+
+    def pop_dirty(self):
+        """取出全部待落库的记录 (qq_number, name, dialogue_count, last_summarized_count, last_active_at)"""
+        rows = [(key, *self._users[key]) for key in self._dirty if key in self._users]
+        rows.extend((key, *entry) for key, entry in self._evicted.items())
+        self._dirty.clear()
+        self._evicted.clear()
+        return rows
+
+    def requeue(self, rows):
+        """落库失败时把记录放回待落库状态"""
+        for key, *entry in rows:
+            if key in self._users:
+                self._dirty.add(key)
+            else:
+                self._evicted[key] = entry
+
+
+class PersonaTemplate:
+    """按 {Impression} 预先切分的人格模板，渲染只需一次拼接
+
+    模板中可以有多个 {Impression}，每处都填入印象文本；写成 {{Impression}} 则原样输出 {Impression}。
+    没有占位符时印象追加到末尾。
+    """
+
+    SLOT = "{Impression}"
+    ESCAPED_SLOT = "{{Impression}}"
+
+    def __init__(self, prompt, begin_dialogs=None, tools=None):
+        self.prompt = prompt
+        self.begin_dialogs = begin_dialogs
+        self.tools = tools
+        self.parts = self.split(prompt or "")
+        self.slots = len(self.parts) - 1
+
+    @classmethod
+    def split(cls, prompt):
+        """切成 占位符数+1 段，转义的占位符还原为字面量"""
+        parts = [""]
+        for i, chunk in enumerate(prompt.split(cls.ESCAPED_SLOT)):
+            if i:
+                parts[-1] += cls.SLOT
+            pieces = chunk.split(cls.SLOT)
+            parts[-1] += pieces[0]
+            parts.extend(pieces[1:])
+        return parts
+
+    def render(self, summary_text):
+        text = str(summary_text)
+        if self.slots:
+            return text.join(self.parts)
+        # 兜底：如果没有占位符，追加到末尾
+        return self.parts[0] + f"\n\n关于用户的印象：{text}"
+
+    # 缓存友好布局中替换占位符的固定文本
+    SLOT_REFERENCE = "（人物关系见末尾）"
+
+    def render_appended(self, summary_text):
+        """缓存友好布局：模板原文在前(占位符换成固定指引，逐字节不变)，印象整体放在末尾"""
+        if not self.slots:
+            return self.render(summary_text)
+        return self.SLOT_REFERENCE.join(self.parts) + f"\n\n{summary_text}"
+
+
+class Histogram:
+    """固定分桶的直方图，只保存各桶计数，分位数取所在桶的上界"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                # 桶上界不会超过实际最大值
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 3),
+            "p99": round(self.quantile(0.99), 3),
+            "max": round(self.max, 3),
+        }
+
+
+class PluginMetrics:
+    """插件内部计数器与直方图，全部在内存中，开销只有一次字典查找"""
+
+    LATENCY_BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+    SIZE_BOUNDS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+    PERCENT_BOUNDS = (10, 25, 50, 75, 90, 95, 99, 100)
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, bounds=SIZE_BOUNDS):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram(bounds)
+        hist.observe(value)
+
+    def observe_ms(self, name, seconds):
+        self.observe(name, seconds * 1000, self.LATENCY_BOUNDS_MS)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_ms(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        return {
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": {
+                name: hist.snapshot() for name, hist in sorted(self.histograms.items())
+            },
+        }
+
+
+class TimedLock:
+    """asyncio.Lock 的包装，记录每次获取锁的等待时间"""
+
+    def __init__(self, metrics, name):
+        self._lock = asyncio.Lock()
+        self._metrics = metrics
+        self._name = name
+
+    def locked(self):
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        await self._lock.acquire()
+        self._metrics.observe_ms(self._name, time.perf_counter() - start)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._lock.release()
+
+
+class TokenBucket:
+    """令牌桶限流：平均每秒 rate 个，最多攒 burst 个"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """取一个令牌，不够时等待到补满为止"""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """连续失败 threshold 次后熔断 cooldown 秒；冷却结束后每个冷却期只放行一次试探请求"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        # 半开：放行这一次，其余请求继续等待下一个冷却期
+        self.opened_at = time.monotonic()
+        return True
+
+    def remaining(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        """记录一次失败，本次失败导致熔断时返回 True"""
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+class SummaryDeferred(Exception):
+    """模型处于熔断状态，总结任务需要推迟 retry_after 秒"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"总结已熔断，{retry_after:.0f} 秒后重试")
+        self.retry_after = retry_after
+
+
+class SummaryCadence:
+    """自适应总结节奏
+
+    每个用户有自己的触发间隔(对话次数)：关系不变且印象措辞相近则间隔翻倍，关系变化则减半；
+    新对话字数较多时提前触发并把间隔减半，长时间不说话时把还没总结的对话补上。
+    所有触发共享每小时的次数上限，超出时保留待总结的计数，额度恢复后再触发。
+
+    用户状态: qq_number -> [间隔, 待总结对话数, 待总结字数, 最近对话时间, (umo, 昵称)]
+    """
+
+    def __init__(self, base, min_interval, max_interval, content_chars, hourly_cap,
+                 max_users=4096):
+        self.min_interval = max(1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.base = min(max(base, self.min_interval), self.max_interval)
+        self.content_chars = content_chars
+        self.hourly_cap = hourly_cap
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._fired = deque()  # 最近一小时内的触发时间
+
+    def __contains__(self, qq_number):
+        return qq_number in self._users
+
+    def interval(self, qq_number):
+        entry = self._users.get(qq_number)
+        return entry[0] if entry else self.base
+
+    def record(self, qq_number, chars, context, newcomer=False, queued=False):
+        """记录一轮对话；返回触发原因 count / content，额度用完时返回 capped，不触发返回 None
+
+        queued 表示该用户已有排队中的总结：它会覆盖这些对话，只清零计数、不占用额度
+        """
+        entry = self._users.get(qq_number)
+        if entry is None:
+            # 新用户先用最短间隔，尽快形成第一印象
+            interval = self.min_interval if newcomer else self.base
+            entry = self._users[qq_number] = [interval, 0, 0, 0.0, None]
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(qq_number)
+        entry[1] += 1
+        entry[2] += chars
+        entry[3] = time.monotonic()
+        entry[4] = context
+
+        if entry[1] >= entry[0]:
+            reason = "count"
+        elif self.content_chars > 0 and entry[2] >= self.content_chars:
+            # 聊得多的用户印象变化可能更快，缩短之后的间隔
+            reason = "content"
+            entry[0] = max(self.min_interval, entry[0] // 2)
+        else:
+            return None
+        if queued:
+            entry[1] = entry[2] = 0
+            return None
+        return reason if self._take(entry) else "capped"
+
+    def idle_due(self, idle_seconds):
+        """超过 idle_seconds 没有新对话、仍有未总结内容的用户，返回 [(qq_number, (umo, 昵称))]"""
+        now = time.monotonic()
+        due = []
+        for qq_number, entry in self._users.items():
+            if entry[1] and now - entry[3] >= idle_seconds:
+                if not self._take(entry):
+                    break
+                due.append((qq_number, entry[4]))
+        return due
+
+    def _take(self, entry):
+        """占用一次每小时额度，成功时清零该用户的待总结计数"""
+        now = time.monotonic()
+        while self._fired and now - self._fired[0] >= 3600:
+            self._fired.popleft()
+        if self.hourly_cap > 0 and len(self._fired) >= self.hourly_cap:
+            return False
+        self._fired.append(now)
+        entry[1] = entry[2] = 0
+        return True
+
+    def fired_last_hour(self):
+        now = time.monotonic()
+        return sum(1 for t in self._fired if now - t < 3600)
+
+    # 印象的字符二元组 Dice 系数达到该值视为措辞不同、内容未变
+    SIMILAR_IMPRESSION = 0.4
+
+    @staticmethod
+    def _normalize(text):
+        """去掉空白和标点并转小写"""
+        return re.sub(r"[\W_]+", "", str(text or "")).lower()
+
+    @classmethod
+    def _bigrams(cls, text):
+        text = cls._normalize(text)
+        return {text[i : i + 2] for i in range(len(text) - 1)} or {text}
+
+    @classmethod
+    def similar(cls, a, b):
+        """两段印象是否相近：印象每次都由 LLM 重写，不能要求逐字相同"""
+        sa, sb = cls._bigrams(a), cls._bigrams(b)
+        return 2 * len(sa & sb) / (len(sa) + len(sb)) >= cls.SIMILAR_IMPRESSION
+
+    def feedback(self, qq_number, before, after):
+        """按总结前后的 (关系, 印象) 调整该用户的间隔，返回新的间隔"""
+        entry = self._users.get(qq_number)
+        if entry is None or not before[0]:
+            return entry[0] if entry else None
+        if self._normalize(before[0]) != self._normalize(after[0]):
+            entry[0] = max(self.min_interval, entry[0] // 2)
+        elif self.similar(before[1], after[1]):
+            entry[0] = min(self.max_interval, entry[0] * 2)
+        return entry[0]
+
+
+def timed(name, routed=False):
+    """记录协程方法耗时到 self.metrics 的装饰器
+
+    routed 为真时第一个参数是事件：转交给分片处理的调用由分片自己计时，这里不重复记录
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if routed and args and self._route(args[0]) is not self:
+                return await func(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                self.metrics.observe_ms(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
 
 @register(
     "astrbot_plugin_PersonaFlow",
@@ -30,17 +851,169 @@ class PersonaFlow(Star):
         self.config = config
         data_dir = StarTools.get_data_dir("astrbot_plugin_PersonaFlow")
         default_path = str(data_dir / "OSNpermemory.db")  # 转换为字符串
+        self.export_dir = str(data_dir / "exports")  # /osn export 与 /osn import 的文件目录
         self.db_path = self.config.get("database_path") or default_path
         self.db = None  # 数据库连接对象初始化为None
-        self._db_lock = asyncio.Lock()  # 1. 添加锁解决并发初始化问题
+        # 运行指标：各数据库操作耗时、锁等待、总结耗时与失败次数等，/osn stats 查看
+        self.metrics = PluginMetrics()
+        self._metrics_task = None
+        self._db_lock = TimedLock(self.metrics, "lock.db_wait")  # 1. 添加锁解决并发初始化问题
+        # 只读连接池：读请求不必排在写连接后面(WAL 模式下读写互不阻塞)
+        self._read_pool = None
+        self._read_conns = []
+        # 按 qq_number 的细粒度锁: qq_number -> [Lock, 等待/持有者数量]
+        self._user_locks = {}
+
+        # 写回缓冲(write-behind)：消息、昵称、对话计数先进入内存队列，由后台任务合并提交
+        self._write_behind = bool(self.config.get("write_behind_enabled", False))
+        self._write_queue = []  # 待落库操作 (op, qq_number, value)
+        self._pending_counts = {}  # qq_number -> 尚未落库的对话次数增量
+        # 正在提交的批次涉及的用户，以及已完成的提交次数；读计数时据此判断是否与提交重叠
+        self._flushing = set()
+        self._flush_generation = 0
+        self._write_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._write_task = None
+
+        # 动态人格 Prompt 缓存: dynamic_id -> (system_prompt, 读取时的 _persona_version)
+        self._persona_cache = {}
+        # 本进程每次写 dynamic_personas、或发现其他进程写过数据库时 +1，旧缓存随之失效
+        self._persona_version = 0
+        self._external_task = None
+
+        # 会话参与者追踪: session_id -> OrderedDict(qq_number)，越靠后说话越近
+        self._session_participants = OrderedDict()
+        # 物化的印象列表，首次使用时从 Impression 表加载，之后按单个用户增量维护
+        self._impression_block = None
+        # 缓存友好布局：模板在前、印象在后，印象分为稳定的核心块与最近更新块
+        self._cache_layout = self.config.get("persona_layout", "classic") == "cache"
+        # 每个人格/会话上一次请求的 System Prompt 分块摘要，用于统计相邻两次的共同前缀
+        self._last_prompts = OrderedDict()
+
+        # 总结调度：有界并发的后台 worker，同一用户的重复触发合并为一个任务
+        self._summary_queue = asyncio.Queue()
+        self._summary_jobs = {}  # qq_number -> 最新的任务参数(排队中或等待重跑)
+        self._summary_running = set()  # 正在总结的 qq_number
+        self._summary_workers = []
+        self._persona_write_lock = asyncio.Lock()  # 串行化"读全部印象 + 写人格"
+        # 按模型的限流器与熔断器；熔断期间的任务推迟执行: qq_number -> TimerHandle
+        self._rate_limiters = {}
+        self._breakers = {}
+        self._summary_deferred = {}
+        # 不支持 JSON 输出模式的模型，之后不再尝试
+        self._json_mode_unsupported = set()
+
+        # 自适应总结节奏；未开启时按 summary_trigger_threshold 固定间隔触发
+        self._cadence = None
+        if self.config.get("summary_adaptive_enabled", False):
+            self._cadence = SummaryCadence(
+                int(self.config.get("summary_trigger_threshold", 5)),
+                int(self.config.get("summary_adaptive_min_interval", 2)),
+                int(self.config.get("summary_adaptive_max_interval", 40)),
+                int(self.config.get("summary_adaptive_content_chars", 2000)),
+                int(self.config.get("summary_max_per_hour", 0)),
+            )
+        self._cadence_task = None
+
+        self._retention_task = None  # 聊天记录保留策略的后台任务
+        self._maintenance_task = None  # 空闲时的数据库维护任务
+        self._last_activity = time.monotonic()  # 最近一次聊天钩子触发的时间
+
+        # 全文索引：分词器为空表示不可用；fts_backfill_upto 及以下的旧记录等待补建
+        self._fts_tokenizer = ""
+        self._fts_backfill_upto = 0
+        self._fts_task = None
+
+        # 紧凑聊天记录存储：用户消息与 AI 回复分列保存、长正文压缩，旧记录由后台任务迁移
+        self._compact_storage = bool(self.config.get("compact_message_storage", False))
+        self._speaker_names = {}  # Speaker.id -> 名称
+        self._speaker_ids = {}  # 名称 -> Speaker.id
+        self._compact_upto = 0  # 后台迁移已检查到的 Message.id
+        self._compact_task = None
+        codec = self.config.get("message_compression", "zlib")
+        if codec not in MESSAGE_CODECS:
+            logger.warning(f"未知的聊天记录压缩方式 {codec}，改用 zlib")
+        elif codec == "zstd" and not ZSTD_AVAILABLE:
+            logger.warning("当前环境没有 zstd 支持(需要 Python 3.14+ 或安装 zstandard)，改用 zlib")
+
+        # /osn check 翻页游标: (关键词, 排序, 每页条数) -> 各页起点，最近使用的排在最后
+        self._check_cursors = OrderedDict()
+
+        # 人格模板索引: 名称 -> (列表位置, 原始人格, PersonaTemplate)，人格列表变化时重建
+        self._template_index = {}
+        self._template_source = None  # 建索引时人格列表的 (id, 长度)
+
+        # 内存用户表：存在性、改名和总结阈值判断不再查库，计数定期落库
+        self._registry_enabled = bool(self.config.get("user_registry_enabled", False))
+        self._user_registry = None  # 由 initialize 在启动时从 Impression 表预热
+        self._registry_task = None
 
         # 4. 确保目录存在
         db_dir = os.path.dirname(self.db_path)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
 
+        # 分片：persona_shards 中的每个人格使用独立的数据库文件和连接，按会话路由
+        self.shard_name = self.config.get("personas_name", "") or "默认"
+        self._shards = {}  # session_id -> 负责该会话的分片实例
+        self._shard_children = []
+        self.is_shard = False  # 由主实例创建的分片为 True
+        self._init_shards()
+
         logger.info("人格关系流(PersonaFlow)加载成功!  路径：" + self.db_path)
 
+    def _init_shards(self):
+        """按 persona_shards 创建分片：每行 "人格名|群号1,群号2|数据库路径(可选)" """
+        used_paths = {os.path.abspath(self.db_path)}
+        for line in self.config.get("persona_shards", []) or []:
+            fields = [f.strip() for f in str(line).split("|")]
+            persona = fields[0]
+            groups = [g.strip() for g in fields[1].split(",") if g.strip()] if len(fields) > 1 else []
+            if not persona or not groups:
+                logger.warning(f"分片配置 '{line}' 缺少人格名或群号，已忽略")
+                continue
+
+            db_path = fields[2] if len(fields) > 2 and fields[2] else ""
+            if not db_path:
+                safe_name = re.sub(r"[^\w]", "_", persona)
+                db_path = os.path.join(
+                    os.path.dirname(self.db_path), f"OSNpermemory_{safe_name}.db"
+                )
+                suffix = 1
+                while os.path.abspath(db_path) in used_paths:
+                    suffix += 1
+                    db_path = os.path.join(
+                        os.path.dirname(self.db_path), f"OSNpermemory_{safe_name}_{suffix}.db"
+                    )
+            used_paths.add(os.path.abspath(db_path))
+
+            # 分片继承全部配置，只替换人格、生效群聊和数据库路径；
+            # 运行指标由主实例合并写入同一个文件，分片自己不导出
+            child = PersonaFlow(
+                self.context,
+                dict(
+                    self.config,
+                    personas_name=persona,
+                    apply_to_group_chat=groups,
+                    database_path=db_path,
+                    persona_shards=[],
+                    metrics_dump_path="",
+                ),
+            )
+            child.is_shard = True
+            self._shard_children.append(child)
+            for group in groups:
+                if group in self._shards:
+                    logger.warning(f"群 {group} 被多个分片配置，使用 {self._shards[group].shard_name}")
+                    continue
+                self._shards[group] = child
+
+    def _route(self, event):
+        """按会话选择分片，未映射到分片的会话由本实例处理"""
+        if not self._shards:
+            return self
+        return self._shards.get(str(event.get_session_id()), self)
+
     # ************数据库操作函数**********
     async def _get_db(self):
         """懒加载获取数据库连接"""
@@ -51,9 +1024,15 @@ class PersonaFlow(Star):
                         self.db = await aiosqlite.connect(
                             self.db_path, check_same_thread=False
                         )
+                        await self._apply_pragmas(self.db, writer=True)
                         # 开启 WAL 模式以获得更好的并发性能
                         await self.db.execute("PRAGMA journal_mode=WAL;")
                         await self._init_tables(self.db)
+                        await self._migrate_schema(self.db)
+                        await self._load_fts_state(self.db)
+                        await self._load_storage_state(self.db)
+                        await self._open_read_pool()
+                        self._start_background_tasks()
                         logger.info("数据库连接并初始化成功")
                     except Exception as e:
                         logger.error(f"数据库连接失败: {e}")
@@ -63,6 +1042,100 @@ class PersonaFlow(Star):
                         raise e
         return self.db
 
+    SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+    TEMP_STORE_MODES = ("DEFAULT", "FILE", "MEMORY")
+
+    def _pragma_profile(self):
+        """按配置生成连接参数 [(名称, 值)]，非法取值回退到默认"""
+        synchronous = str(self.config.get("sqlite_synchronous", "NORMAL")).upper()
+        if synchronous not in self.SYNCHRONOUS_MODES:
+            logger.warning(f"未知的 sqlite_synchronous: {synchronous}，改用 NORMAL")
+            synchronous = "NORMAL"
+        temp_store = str(self.config.get("sqlite_temp_store", "MEMORY")).upper()
+        if temp_store not in self.TEMP_STORE_MODES:
+            logger.warning(f"未知的 sqlite_temp_store: {temp_store}，改用 MEMORY")
+            temp_store = "MEMORY"
+        return [
+            ("synchronous", synchronous),
+            # 负数表示以 KiB 为单位
+            ("cache_size", -max(0, int(self.config.get("sqlite_cache_size_kb", 8192)))),
+            ("mmap_size", max(0, int(self.config.get("sqlite_mmap_size_mb", 0))) * 1024 * 1024),
+            ("temp_store", temp_store),
+            ("busy_timeout", max(0, int(self.config.get("sqlite_busy_timeout_ms", 5000)))),
+        ]
+
+    async def _apply_pragmas(self, db, writer=False):
+        """连接建立后应用 PRAGMA 配置；只读连接不设置 synchronous"""
+        if writer:
+            async with db.execute("PRAGMA page_count") as cursor:
+                is_new = (await cursor.fetchone())[0] == 0
+            if is_new:
+                # 只有建表前设置才生效，已有数据库需要一次 VACUUM 才能切换
+                await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # ANALYZE 每个索引最多采样的行数，让 PRAGMA optimize 保持在毫秒级
+            await db.execute("PRAGMA analysis_limit = 400")
+        for name, value in self._pragma_profile():
+            if name == "synchronous" and not writer:
+                continue
+            # PRAGMA 不支持参数绑定，取值已在 _pragma_profile 中校验
+            await db.execute(f"PRAGMA {name} = {value}")
+
+    async def _open_read_pool(self):
+        """打开只读连接池，read_pool_size 为 0 时读操作继续使用写连接"""
+        size = int(self.config.get("read_pool_size", 2))
+        if size <= 0:
+            return
+        uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        pool = asyncio.Queue()
+        try:
+            for _ in range(size):
+                conn = await aiosqlite.connect(uri, uri=True, check_same_thread=False)
+                self._read_conns.append(conn)
+                await self._apply_pragmas(conn)
+                pool.put_nowait(conn)
+        except Exception as e:
+            logger.warning(f"打开只读连接失败，读操作将使用写连接: {e}")
+            await self._close_read_pool()
+            return
+        self._read_pool = pool
+
+    async def _close_read_pool(self):
+        self._read_pool = None
+        conns, self._read_conns = self._read_conns, []
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"关闭只读连接失败: {e}")
+
+    @contextlib.asynccontextmanager
+    async def _read_conn(self):
+        """借出一个只读连接，用完归还；未启用连接池时借出写连接"""
+        db = await self._get_db()
+        if self._read_pool is None:
+            yield db
+            return
+        conn = await self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def _user_lock(self, qq_number):
+        """按 qq_number 加锁，不同用户之间互不等待；无人使用时自动回收"""
+        entry = self._user_locks.get(qq_number)
+        if entry is None:
+            entry = self._user_locks[qq_number] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._user_locks.pop(qq_number, None)
+
     async def _init_tables(self, db):
         """初始化表格"""
         try:
@@ -102,6 +1175,265 @@ class PersonaFlow(Star):
             logger.error(f"建表失败: {e}")
             await db.rollback()
 
+    # ************数据库结构迁移**********
+    # 版本号记录在 PRAGMA user_version 中，_init_tables 建出的是第 0 版结构。
+    # 新的结构变更：递增 SCHEMA_VERSION 并新增对应的 _migration_N 方法，不要修改已发布的迁移。
+    SCHEMA_VERSION = 7
+
+    async def _migrate_schema(self, db):
+        """按版本号依次执行迁移，每个版本一个事务，已有数据库原地升级"""
+        async with db.execute("PRAGMA user_version") as cursor:
+            current = (await cursor.fetchone())[0]
+
+        for version in range(current + 1, self.SCHEMA_VERSION + 1):
+            migration = getattr(self, f"_migration_{version}")
+            try:
+                await db.execute("BEGIN")
+                await migration(db)
+                # PRAGMA 不支持参数绑定，version 为内部整数
+                await db.execute(f"PRAGMA user_version = {version}")
+                await db.commit()
+                logger.info(f"数据库结构已升级到版本 {version}: {migration.__doc__}")
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"数据库结构升级到版本 {version} 失败: {e}")
+                raise
+
+    async def _migration_1(self, db):
+        """Message 表增加 (qq_number, id) 索引"""
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_message_qq_id ON Message (qq_number, id)"
+        )
+
+    async def _migration_2(self, db):
+        """新增聊天记录归档表 MessageArchive"""
+        # payload: zlib 压缩的 JSON 数组 [[id, chat_time, message], ...]
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS MessageArchive (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                qq_number TEXT NOT NULL,
+                first_message_id INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_archive_qq ON MessageArchive (qq_number, first_message_id)"
+        )
+
+    async def _migration_3(self, db):
+        """Impression 表增加 last_summarized_count 列"""
+        await self._add_column(
+            db, "Impression", "last_summarized_count", "INTEGER DEFAULT 0"
+        )
+        # 已有用户按固定间隔的触发点回填，否则开启内存用户表后所有老用户会在下一条消息时同时触发总结
+        threshold = max(1, int(self.config.get("summary_trigger_threshold", 5)))
+        await db.execute(
+            "UPDATE Impression SET last_summarized_count = "
+            "COALESCE(dialogue_count, 0) - COALESCE(dialogue_count, 0) % ?",
+            (threshold,),
+        )
+
+    async def _migration_4(self, db):
+        """Impression 表增加 last_active_at 列(最近一次对话的 UTC 时间)"""
+        await self._add_column(db, "Impression", "last_active_at", "DATETIME")
+
+    async def _migration_5(self, db):
+        """Impression 表增加 last_summarized_message_id 列(已总结到的最后一条聊天记录 id)"""
+        await self._add_column(
+            db, "Impression", "last_summarized_message_id", "INTEGER DEFAULT 0"
+        )
+        # 已有用户的水位回填到最近 summary_history_count 条记录之前，
+        # 否则升级后的第一次总结会从最早的聊天记录开始，要很多轮才能追上最近的对话
+        history_count = max(1, int(self.config.get("summary_history_count", 20)))
+        await db.execute(
+            "UPDATE Impression SET last_summarized_message_id = COALESCE(("
+            "SELECT id FROM Message WHERE Message.qq_number = Impression.qq_number "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?), 0)",
+            (history_count,),
+        )
+
+    async def _migration_6(self, db):
+        """聊天记录全文索引 MessageFTS(FTS5)，已有记录由后台任务分批补建"""
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS PluginMeta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        # trigram 分词支持中文任意子串搜索(SQLite 3.34+)，不支持时退回 unicode61
+        tokenizer = ""
+        for candidate in ("trigram", "unicode61"):
+            try:
+                await db.execute(
+                    "CREATE VIRTUAL TABLE MessageFTS USING fts5("
+                    "message, content='Message', content_rowid='id', "
+                    f"tokenize='{candidate}')"
+                )
+                tokenizer = candidate
+                break
+            except Exception as e:
+                logger.warning(f"创建 {candidate} 全文索引失败: {e}")
+        if not tokenizer:
+            logger.warning("当前 SQLite 不支持 FTS5，聊天记录搜索不可用")
+
+        async with db.execute("SELECT COALESCE(MAX(id), 0) FROM Message") as cursor:
+            backfill_upto = (await cursor.fetchone())[0] if tokenizer else 0
+        await db.executemany(
+            "INSERT OR REPLACE INTO PluginMeta (key, value) VALUES (?, ?)",
+            [("fts_tokenizer", tokenizer), ("fts_backfill_upto", str(backfill_upto))],
+        )
+        if not tokenizer:
+            return
+
+        # id 不大于 fts_backfill_upto 的记录还没进索引，由补建任务负责，触发器跳过它们
+        pending = (
+            "(SELECT CAST(value AS INTEGER) FROM PluginMeta WHERE key = 'fts_backfill_upto')"
+        )
+        await db.execute(f"""
+            CREATE TRIGGER message_fts_insert AFTER INSERT ON Message
+            WHEN new.id > {pending} BEGIN
+                INSERT INTO MessageFTS (rowid, message) VALUES (new.id, new.message);
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER message_fts_delete AFTER DELETE ON Message
+            WHEN old.id > {pending} BEGIN
+                INSERT INTO MessageFTS (MessageFTS, rowid, message)
+                VALUES ('delete', old.id, old.message);
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER message_fts_update AFTER UPDATE OF message ON Message
+            WHEN old.id > {pending} BEGIN
+                INSERT INTO MessageFTS (MessageFTS, rowid, message)
+                VALUES ('delete', old.id, old.message);
+                INSERT INTO MessageFTS (rowid, message) VALUES (new.id, new.message);
+            END
+        """)
+
+    async def _migration_7(self, db):
+        """聊天记录紧凑存储：新增 Speaker 表，Message 表增加分列的正文与说话人 id"""
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS Speaker ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE)"
+        )
+        # 正文为 TEXT，压缩后为 BLOB，列不声明类型以免发生类型转换
+        await self._add_column(db, "Message", "user_text", "BLOB")
+        await self._add_column(db, "Message", "ai_text", "BLOB")
+        await self._add_column(db, "Message", "speaker_id", "INTEGER")
+        await self._add_column(db, "Message", "ai_speaker_id", "INTEGER")
+        await db.execute(
+            "INSERT OR IGNORE INTO PluginMeta (key, value) VALUES ('compact_migrated_upto', '0')"
+        )
+
+        async with db.execute(
+            "SELECT value FROM PluginMeta WHERE key = 'fts_tokenizer'"
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not (row and row[0]):
+            return
+        # 紧凑格式的记录 message 为 NULL，它们的索引由插件写入时直接维护，触发器只处理整段文本。
+        # 旧记录迁移为紧凑格式时内容不变，已有的索引项原样保留
+        pending = (
+            "(SELECT CAST(value AS INTEGER) FROM PluginMeta WHERE key = 'fts_backfill_upto')"
+        )
+        for name in ("message_fts_insert", "message_fts_delete", "message_fts_update"):
+            await db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await db.execute(f"""
+            CREATE TRIGGER message_fts_insert AFTER INSERT ON Message
+            WHEN new.id > {pending} AND new.message IS NOT NULL BEGIN
+                INSERT INTO MessageFTS (rowid, message) VALUES (new.id, new.message);
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER message_fts_delete AFTER DELETE ON Message
+            WHEN old.id > {pending} AND old.message IS NOT NULL BEGIN
+                INSERT INTO MessageFTS (MessageFTS, rowid, message)
+                VALUES ('delete', old.id, old.message);
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER message_fts_update AFTER UPDATE OF message ON Message
+            WHEN old.id > {pending} AND old.message IS NOT NULL
+                AND new.message IS NOT NULL BEGIN
+                INSERT INTO MessageFTS (MessageFTS, rowid, message)
+                VALUES ('delete', old.id, old.message);
+                INSERT INTO MessageFTS (rowid, message) VALUES (new.id, new.message);
+            END
+        """)
+
+    @staticmethod
+    async def _add_column(db, table, column, definition):
+        """列不存在时才添加(兼容手动改过结构的旧数据库)"""
+        async with db.execute(f"PRAGMA table_info({table})") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if column not in columns:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _start_background_tasks(self):
+        """数据库就绪后启动常驻后台任务"""
+        if self._external_task is None:
+            self._external_task = asyncio.create_task(self._external_change_loop())
+        if self._retention_enabled() and self._retention_task is None:
+            self._retention_task = asyncio.create_task(self._retention_loop())
+        if self._registry_enabled and self._registry_task is None:
+            self._registry_task = asyncio.create_task(self._registry_flush_loop())
+        if self.config.get("metrics_dump_path") and self._metrics_task is None:
+            self._metrics_task = asyncio.create_task(self._metrics_dump_loop())
+        if self._fts_backfill_upto > 0 and self._fts_task is None:
+            self._fts_task = asyncio.create_task(self._fts_backfill_loop())
+        if self._compact_storage and self._compact_task is None:
+            self._compact_task = asyncio.create_task(self._compact_migration_loop())
+        if (
+            self._cadence is not None
+            and int(self.config.get("summary_idle_seconds", 600)) > 0
+            and self._cadence_task is None
+        ):
+            self._cadence_task = asyncio.create_task(self._cadence_idle_loop())
+        if (
+            int(self.config.get("maintenance_interval_minutes", 30)) > 0
+            and self._maintenance_task is None
+        ):
+            if self._read_pool is None:
+                # 没有只读连接池时读操作不经过写锁直接借用写连接，维护的时间上限会误伤这些读
+                logger.info("未启用只读连接池，跳过空闲时的数据库维护")
+            else:
+                self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def _metrics_dump_loop(self):
+        """定期把运行指标写入本地 JSON 文件"""
+        interval = max(1, int(self.config.get("metrics_dump_interval_seconds", 60)))
+        while True:
+            await asyncio.sleep(interval)
+            await self.dump_metrics()
+
+    async def dump_metrics(self):
+        """把当前指标写入 metrics_dump_path(先写临时文件再替换，避免读到半个文件)
+
+        各分片的指标放在 shards 下，以分片人格名为键
+        """
+        path = self.config.get("metrics_dump_path")
+        if not path:
+            return
+        snapshot = self.metrics.snapshot()
+        if self._shard_children:
+            snapshot["shards"] = {
+                child.shard_name: child.metrics.snapshot() for child in self._shard_children
+            }
+        text = json.dumps(snapshot, ensure_ascii=False, indent=2)
+
+        def write():
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+
+        try:
+            await asyncio.to_thread(write)
+        except Exception as e:
+            logger.error(f"写入运行指标文件失败: {e}")
+
+    @timed("db.insert_user")
     async def insert_user(self, qq_number, user_name):
         """插入用户信息到数据库"""
         db = await self._get_db()
@@ -110,132 +1442,391 @@ class PersonaFlow(Star):
                 sql = "INSERT INTO Impression (qq_number, name) VALUES (?, ?)"
                 await db.execute(sql, (qq_number, user_name))
                 await db.commit()
+                self._update_impression_block(qq_number, insert=True, name=user_name)
                 logger.info(f"用户 {user_name} ({qq_number}) 插入数据库")
             except Exception as e:
                 logger.error(f"插入用户失败: {e}")
                 await db.rollback()
 
+    @timed("db.select_dialogue_count")
     async def select_dialogue_count(self, qq_number):
-        """查询对话次数"""
-        db = await self._get_db()
+        """查询对话次数(包含写回缓冲中尚未落库的增量)"""
+        if self._user_registry is not None:
+            entry = self._user_registry.get(qq_number)
+            if entry is not None:
+                return entry[1]
         try:
-            sql = "SELECT dialogue_count FROM Impression WHERE qq_number = ?"
-            async with db.execute(sql, (qq_number,)) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result and result[0] is not None else 0
+            generation = self._flush_generation
+            overlapped = qq_number in self._flushing
+            count = await self._select_stored_dialogue_count(qq_number)
+            if overlapped or qq_number in self._flushing or generation != self._flush_generation:
+                # 查询期间有提交在进行，库中计数可能已经包含待定增量；
+                # 只有这种少见的重叠才等提交结束后重读，平时不与提交争锁
+                async with self._flush_lock:
+                    count = await self._select_stored_dialogue_count(qq_number)
+                    return count + self._pending_counts.get(qq_number, 0)
+            return count + self._pending_counts.get(qq_number, 0)
         except Exception as e:
             logger.error(f"查询对话次数失败: {e}")
             return 0
 
+    async def _select_stored_dialogue_count(self, qq_number):
+        async with self._read_conn() as db:
+            sql = "SELECT dialogue_count FROM Impression WHERE qq_number = ?"
+            async with db.execute(sql, (qq_number,)) as cursor:
+                result = await cursor.fetchone()
+        return result[0] if result and result[0] is not None else 0
+
+    @timed("db.increment_dialogue_count")
     async def increment_dialogue_count(self, qq_number):
         """对话次数+1"""
         db = await self._get_db()
         async with self._db_lock:
             try:
-                sql = "UPDATE Impression SET dialogue_count = dialogue_count + 1 WHERE qq_number = ?"
+                sql = (
+                    "UPDATE Impression SET dialogue_count = dialogue_count + 1, "
+                    "last_active_at = CURRENT_TIMESTAMP WHERE qq_number = ?"
+                )
                 await db.execute(sql, (qq_number,))
                 await db.commit()
             except Exception as e:
                 logger.error(f"更新对话次数失败: {e}")
                 await db.rollback()
 
+    @timed("db.set_relationship_impression")
     async def set_sql_relationship_impression(
-        self, qq_number, relationship, impression
+        self, qq_number, relationship, impression, last_message_id=0
     ):
-        """更新关系与印象"""
+        """更新关系与印象，并把总结水位推进到 last_message_id；写库失败时返回 False"""
         db = await self._get_db()
         async with self._db_lock:
             try:
-                sql = "UPDATE Impression SET relationship = ?, impression = ? WHERE qq_number = ?"
-                await db.execute(sql, (relationship, impression, qq_number))
+                sql = (
+                    "UPDATE Impression SET relationship = ?, impression = ?, "
+                    "last_summarized_message_id = "
+                    "MAX(COALESCE(last_summarized_message_id, 0), ?) WHERE qq_number = ?"
+                )
+                await db.execute(sql, (relationship, impression, last_message_id, qq_number))
                 await db.commit()
+                self._update_impression_block(
+                    qq_number, relationship=relationship, impression=impression
+                )
                 logger.info("关系与印象更新成功")
+                return True
             except Exception as e:
                 logger.error(f"更新关系与印象失败: {e}")
                 await db.rollback()
+                return False
+
+    @timed("db.set_relationship_impression_many")
+    async def set_sql_relationship_impression_many(self, rows):
+        """在一个事务中更新多个用户的关系与印象，rows: [(relationship, impression, last_message_id, qq_number)]
+
+        写库失败时返回 False，调用方应视为这些用户都没有总结成功
+        """
+        db = await self._get_db()
+        async with self._db_lock:
+            try:
+                sql = (
+                    "UPDATE Impression SET relationship = ?, impression = ?, "
+                    "last_summarized_message_id = "
+                    "MAX(COALESCE(last_summarized_message_id, 0), ?) WHERE qq_number = ?"
+                )
+                await db.executemany(sql, rows)
+                await db.commit()
+                for relationship, impression, _, qq_number in rows:
+                    self._update_impression_block(
+                        qq_number, relationship=relationship, impression=impression
+                    )
+                logger.info(f"{len(rows)} 个用户的关系与印象更新成功")
+                return True
+            except Exception as e:
+                logger.error(f"批量更新关系与印象失败: {e}")
+                await db.rollback()
+                return False
+
+    async def _get_impression_block(self):
+        """获取物化的印象列表，首次调用时整表加载一次"""
+        if self._impression_block is None:
+            db = await self._get_db()
+            # 持有写锁加载，保证加载期间不会漏掉并发的更新
+            async with self._db_lock:
+                if self._impression_block is None:
+                    sql = (
+                        "SELECT qq_number, name, relationship, impression, "
+                        "dialogue_count, last_active_at FROM Impression ORDER BY rowid"
+                    )
+                    async with db.execute(sql) as cursor:
+                        rows = await cursor.fetchall()
+                    recent_limit = 0
+                    if self._cache_layout:
+                        recent_limit = int(self.config.get("persona_recent_block_size", 10))
+                    self._impression_block = ImpressionBlock(rows, recent_limit)
+                    logger.info(f"已加载 {len(rows)} 条印象记录")
+        return self._impression_block
+
+    def _update_impression_block(self, qq_number, insert=False, **fields):
+        """写库成功后同步更新该用户的印象行(需在 _db_lock 内调用)；未加载时无需处理
+
+        只有插入了用户行的写入才传 insert=True，UPDATE 可能没有匹配到行，不能凭空新增用户
+        """
+        if self._impression_block is None:
+            return
+        if insert:
+            self._impression_block.upsert(qq_number, **fields)
+        else:
+            self._impression_block.update(qq_number, **fields)
 
     async def get_sql_relationship_impression(self):
         """获取全部关系与印象"""
-        db = await self._get_db()
         try:
-            # 1. 查询需要的四个字段
-            sql = "SELECT qq_number, name, relationship, impression FROM Impression"
-            async with db.execute(sql) as cursor:
-                # 2. 获取所有结果 (fetchall)
-                results = await cursor.fetchall()
-
-            if not results:
+            block = await self._get_impression_block()
+            if not len(block):
                 logger.info("数据库中暂无印象记录")
-                return "暂无已知的关系与印象记录。"
-
-            info_list = []
-
-            # 3. 循环处理每一行数据
-            for row in results:
-                # 按照 SQL 顺序提取字段，并处理 None 的情况
-                r_qq = row[0]
-                r_name = row[1] if row[1] is not None else "未知昵称"
-                r_rel = row[2] if row[2] is not None else "无"
-                r_imp = row[3] if row[3] is not None else "无"
-
-                # 4. 单条记录拼接
-                line = f"{r_name}({r_qq})，关系：{r_rel}，印象：{r_imp}。"
-                info_list.append(line)
-
-            # 5. 将所有人的记录用换行符拼接
-            final_prompt = "已知的人物关系如下：\n" + "\n".join(info_list)
-
-            # logger.info(f"成功获取 {len(info_list)} 条关系记录")
-            return final_prompt
+            return block.render(int(self.config.get("impression_token_budget", 0)))
 
         except Exception as e:
             logger.error(f"获取全部关系与印象失败: {e}")
             return "获取关系数据出错。"
 
-    async def add_persona_chat_history(self, qq_number, message):
-        """添加用户的聊天记录到数据库"""
+    async def get_session_impression(self, qq_numbers):
+        """只获取指定用户(当前会话参与者)的关系与印象"""
+        try:
+            block = await self._get_impression_block()
+        except Exception as e:
+            logger.error(f"获取会话关系与印象失败: {e}")
+            return "获取关系数据出错。"
+
+        # 缓存友好布局下按入库顺序排列，发言先后变化不改变文本
+        lines = block.lines_for(qq_numbers, stable=self._cache_layout)
+        if not lines:
+            return ImpressionBlock.EMPTY
+        return ImpressionBlock.HEADER + "\n".join(lines)
+
+    # 最多追踪的会话数，超过后淘汰最久未活跃的会话
+    MAX_TRACKED_SESSIONS = 1024
+
+    def _track_participant(self, session_id, qq_number):
+        """记录会话中的发言者，返回最近 K 个不同发言者(由远到近)"""
+        participants = self._session_participants.get(session_id)
+        if participants is None:
+            participants = self._session_participants[session_id] = OrderedDict()
+            if len(self._session_participants) > self.MAX_TRACKED_SESSIONS:
+                self._session_participants.popitem(last=False)
+        else:
+            self._session_participants.move_to_end(session_id)
+
+        participants[qq_number] = None
+        participants.move_to_end(qq_number)
+        limit = max(1, int(self.config.get("session_participant_limit", 20)))
+        while len(participants) > limit:
+            participants.popitem(last=False)
+        return list(participants)
+
+    @timed("db.add_chat_history")
+    async def add_persona_chat_history(self, qq_number, user_name, user_message, ai_message):
+        """添加一轮对话的聊天记录到数据库"""
         db = await self._get_db()
         async with self._db_lock:
             try:
-                sql = "INSERT INTO Message (qq_number, message) VALUES (?, ?)"
-                await db.execute(sql, (qq_number, message))
+                new_speakers = await self._insert_messages(
+                    db, [(qq_number, user_name, user_message, ai_message)]
+                )
                 await db.commit()
+                self._remember_speakers(new_speakers)
             except Exception as e:
                 logger.error(f"插入聊天记录失败: {e}")
                 await db.rollback()
 
-    async def get_recent_chat_history(self, qq_number, n):
-        """获取用户的最近n条聊天记录"""
-        db = await self._get_db()
+    # 读取聊天记录时查询的列，交给 _decode_messages 还原为整段文本
+    MESSAGE_COLUMNS = "message, user_text, ai_text, speaker_id, ai_speaker_id"
+
+    async def _insert_messages(self, db, rows):
+        """在当前事务中插入聊天记录 [(qq_number, 用户名, 用户消息, AI 回复)]
+
+        返回本次新建的说话人 {名称: id}，调用方提交成功后交给 _remember_speakers
+        """
+        ai_name = self.config.get("personas_name", "AI助手")
+        if not self._compact_storage:
+            await db.executemany(
+                "INSERT INTO Message (qq_number, message) VALUES (?, ?)",
+                [
+                    (qq_number, merge_message(user_name, user_text, ai_name, ai_text))
+                    for qq_number, user_name, user_text, ai_text in rows
+                ],
+            )
+            return {}
+
+        threshold = int(self.config.get("message_compress_threshold", 512))
+        codec = self.config.get("message_compression", "zlib")
+        new_speakers = {}
+        for qq_number, user_name, user_text, ai_text in rows:
+            speaker_id = await self._speaker_id(db, user_name, new_speakers)
+            ai_speaker_id = await self._speaker_id(db, ai_name, new_speakers)
+            user_body = encode_body(user_text, threshold, codec)
+            ai_body = encode_body(ai_text, threshold, codec)
+            compressed = isinstance(user_body, bytes) + isinstance(ai_body, bytes)
+            if compressed:
+                self.metrics.incr("storage.compressed", compressed)
+            async with db.execute(
+                "INSERT INTO Message (qq_number, user_text, ai_text, speaker_id, ai_speaker_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (qq_number, user_body, ai_body, speaker_id, ai_speaker_id),
+            ) as cursor:
+                message_id = cursor.lastrowid
+            if self._fts_tokenizer:
+                # 触发器看不到紧凑记录的正文，索引在这里直接写入
+                await db.execute(
+                    "INSERT INTO MessageFTS (rowid, message) VALUES (?, ?)",
+                    (message_id, merge_message(user_name, user_text, ai_name, ai_text)),
+                )
+        return new_speakers
+
+    async def _speaker_id(self, db, name, new_speakers):
+        speaker_id = self._speaker_ids.get(name) or new_speakers.get(name)
+        if speaker_id is None:
+            await db.execute("INSERT OR IGNORE INTO Speaker (name) VALUES (?)", (name,))
+            async with db.execute("SELECT id FROM Speaker WHERE name = ?", (name,)) as cursor:
+                speaker_id = (await cursor.fetchone())[0]
+            new_speakers[name] = speaker_id
+        return speaker_id
+
+    def _remember_speakers(self, speakers):
+        for name, speaker_id in speakers.items():
+            self._speaker_ids[name] = speaker_id
+            self._speaker_names[speaker_id] = name
+
+    async def _load_speakers(self, db):
+        async with db.execute("SELECT id, name FROM Speaker") as cursor:
+            self._remember_speakers({name: speaker_id for speaker_id, name in await cursor.fetchall()})
+
+    async def _load_storage_state(self, db):
+        await self._load_speakers(db)
+        async with db.execute(
+            "SELECT value FROM PluginMeta WHERE key = 'compact_migrated_upto'"
+        ) as cursor:
+            row = await cursor.fetchone()
+        self._compact_upto = int(row[0]) if row else 0
+
+    async def _decode_messages(self, rows):
+        """把 MESSAGE_COLUMNS 查出的行还原为整段聊天记录，紧凑格式的记录在这里解压、拼接"""
+        if any(row[0] is None and row[3] not in self._speaker_names for row in rows):
+            # 别的连接新建的说话人，重新加载一次
+            async with self._read_conn() as db:
+                await self._load_speakers(db)
+        return [
+            decode_message(
+                row[0],
+                row[1],
+                row[2],
+                self._speaker_names.get(row[3], ""),
+                self._speaker_names.get(row[4], ""),
+            )
+            for row in rows
+        ]
+
+    @timed("db.get_summary_state")
+    async def get_summary_state(self, qq_number):
+        """读取用户已有的关系、印象和总结水位，返回 (relationship, impression, last_message_id)"""
+        try:
+            sql = (
+                "SELECT relationship, impression, last_summarized_message_id "
+                "FROM Impression WHERE qq_number = ?"
+            )
+            async with self._read_conn() as db:
+                async with db.execute(sql, (qq_number,)) as cursor:
+                    row = await cursor.fetchone()
+            if row:
+                return row[0], row[1], row[2] or 0
+        except Exception as e:
+            logger.error(f"读取总结水位失败: {e}")
+        return None, None, 0
+
+    @timed("db.get_chat_history_since")
+    async def get_chat_history_since(self, qq_number, after_id, n):
+        """获取水位之后最早的 n 条聊天记录，返回 (消息列表, 第一条的 id, 最后一条的 id)
+
+        超过 n 条时剩下的留给下一次总结，水位只推进到最后一条，不会跳过任何记录
+        """
         try:
-            sql = "SELECT message FROM Message WHERE qq_number = ? ORDER BY chat_time DESC LIMIT ?"
-            async with db.execute(sql, (qq_number, n)) as cursor:
-                results = await cursor.fetchall()
-            messages = [row[0] for row in results]
-            logger.info(f"成功获取用户 {qq_number} 的最近 {n} 条聊天记录")
-            return messages[::-1]
+            sql = (
+                f"SELECT id, {self.MESSAGE_COLUMNS} FROM Message WHERE qq_number = ? AND id > ? "
+                "ORDER BY id LIMIT ?"
+            )
+            async with self._read_conn() as db:
+                async with db.execute(sql, (qq_number, after_id, n)) as cursor:
+                    results = await cursor.fetchall()
+            if not results:
+                return [], after_id, after_id
+            messages = await self._decode_messages([row[1:] for row in results])
+            return messages, results[0][0], results[-1][0]
         except Exception as e:
             logger.error(f"获取聊天记录失败: {e}")
-            return []
+            return [], after_id, after_id
+
+    @staticmethod
+    def _format_prior_impression(relationship, impression):
+        if not relationship and not impression:
+            return "暂无(第一次总结)"
+        return f"关系：{relationship or '暂无'}，印象：{impression or '暂无'}"
+
+    # 检查其他进程写入的间隔(秒)
+    EXTERNAL_CHECK_SECONDS = 1.0
+
+    async def _external_change_loop(self):
+        """后台任务：轮询写连接的 PRAGMA data_version，发现其他连接提交过写入时作废内存缓存
 
+        data_version 只在其他连接(其他进程、命令行导入)提交后变化，本进程写连接的写入不会触发
+        """
+        last = None
+        while True:
+            try:
+                async with self.db.execute("PRAGMA data_version") as cursor:
+                    version = (await cursor.fetchone())[0]
+            except Exception as e:
+                logger.debug(f"读取 data_version 失败: {e}")
+            else:
+                if last is not None and version != last:
+                    self._on_external_change()
+                last = version
+            await asyncio.sleep(self.EXTERNAL_CHECK_SECONDS)
+
+    def _on_external_change(self):
+        """数据库被其他进程修改过：作废依赖数据库内容的缓存"""
+        self._persona_version += 1
+        self._persona_cache.clear()
+        # 印象列表下次使用时从 Impression 表重新加载
+        self._impression_block = None
+
+    @timed("db.get_dynamic_persona")
     async def get_dynamic_persona(self, p_id: str):
-        """获取动态人格 Prompt"""
-        db = await self._get_db()
+        """获取动态人格 Prompt(带版本校验的内存缓存，命中时不访问数据库)"""
+        version = self._persona_version
+        cached = self._persona_cache.get(p_id)
+        if cached is not None and cached[1] == version:
+            return cached[0]
+
         try:
             sql = "SELECT system_prompt FROM dynamic_personas WHERE persona_id = ?"
-            async with db.execute(sql, (p_id,)) as cursor:
-                result = await cursor.fetchone()
+            async with self._read_conn() as db:
+                async with db.execute(sql, (p_id,)) as cursor:
+                    result = await cursor.fetchone()
 
+            # 记下查库前的版本：查库期间发生的写入会让这条缓存在下次调用时失效
             if result:
                 logger.info(f"成功获取人格: {p_id}")
+                self._persona_cache[p_id] = (result[0], version)
                 return result[0]
             else:
                 logger.debug(f"未找到人格 ID: {p_id}")
+                # 未生成的人格也缓存，避免每次请求都查库
+                self._persona_cache[p_id] = (None, version)
                 return None
         except Exception as e:
             logger.error(f"数据库查询失败: {e}")
             return None
 
+    @timed("db.update_user_name")
     async def update_user_name_only(self, qq_number, name):
         """更新用户名"""
         db = await self._get_db()
@@ -244,17 +1835,746 @@ class PersonaFlow(Star):
                 sql = "UPDATE Impression SET name = ? WHERE qq_number = ?"
                 await db.execute(sql, (name, qq_number))
                 await db.commit()
+                self._update_impression_block(qq_number, name=name)
                 logger.info(f"更新用户 {qq_number} 昵称为: {name}")
             except Exception as e:
                 logger.error(f"更新user_name失败: {e}")
                 await db.rollback()
 
+    # ************ 写回缓冲(write-behind) **********
+
+    def _enqueue_write(self, op, qq_number, value=None):
+        """写操作入队: message(聊天记录，值为 (用户名, 用户消息, AI 回复)) / user(插入或改名) / count(对话次数+1)"""
+        self._write_queue.append((op, qq_number, value))
+        if op == "count":
+            self._pending_counts[qq_number] = self._pending_counts.get(qq_number, 0) + 1
+
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_behind_loop())
+
+        flush_size = max(1, int(self.config.get("write_behind_flush_size", 100)))
+        if len(self._write_queue) >= flush_size:
+            self._write_event.set()
+
+    async def _write_behind_loop(self):
+        """后台任务：每隔 N 毫秒或攒够 M 条操作时批量提交"""
+        interval_ms = max(10, int(self.config.get("write_behind_flush_interval_ms", 200)))
+        while True:
+            try:
+                await asyncio.wait_for(self._write_event.wait(), interval_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._write_event.clear()
+            try:
+                # shield: 卸载时取消任务也不会打断正在进行的提交
+                await asyncio.shield(self.flush_write_buffer())
+            except Exception as e:
+                logger.error(f"写回缓冲提交失败: {e}")
+
+    @timed("db.flush_write_buffer")
+    async def flush_write_buffer(self):
+        """把缓冲队列中的操作合并到一个事务中写入数据库"""
+        async with self._flush_lock:
+            if not self._write_queue:
+                return
+
+            batch, self._write_queue = self._write_queue, []
+            messages = []
+            names = {}  # 同一用户只保留最新昵称
+            counts = {}
+            for op, qq_number, value in batch:
+                if op == "message":
+                    messages.append((qq_number, *value))
+                elif op == "user":
+                    names[qq_number] = value
+                elif op == "count":
+                    counts[qq_number] = counts.get(qq_number, 0) + 1
+
+            db = await self._get_db()
+            self._flushing = set(counts)
+            try:
+                await self._commit_write_batch(db, batch, messages, names, counts)
+            finally:
+                self._flushing = set()
+                self._flush_generation += 1
+
+    async def _commit_write_batch(self, db, batch, messages, names, counts):
+        """在一个事务中写入一批缓冲操作，提交成功后扣除待定计数；失败时操作放回队列"""
+        async with self._db_lock:
+            try:
+                # 先插入/改名，保证累加计数时用户行已存在
+                await db.executemany(
+                    "INSERT INTO Impression (qq_number, name) VALUES (?, ?) "
+                    "ON CONFLICT(qq_number) DO UPDATE SET name = excluded.name "
+                    "WHERE Impression.name IS NOT excluded.name",
+                    list(names.items()),
+                )
+                new_speakers = await self._insert_messages(db, messages)
+                await db.executemany(
+                    "UPDATE Impression SET dialogue_count = dialogue_count + ?, "
+                    "last_active_at = CURRENT_TIMESTAMP WHERE qq_number = ?",
+                    [(n, qq_number) for qq_number, n in counts.items()],
+                )
+                await db.commit()
+            except Exception as e:
+                logger.error(f"批量写入失败，{len(batch)} 条操作留待下次提交: {e}")
+                await db.rollback()
+                self._write_queue[:0] = batch
+                return
+
+            self._remember_speakers(new_speakers)
+            for qq_number, name in names.items():
+                self._update_impression_block(qq_number, insert=True, name=name)
+
+            # 已落库的增量从待定计数中扣除
+            for qq_number, n in counts.items():
+                left = self._pending_counts.get(qq_number, 0) - n
+                if left > 0:
+                    self._pending_counts[qq_number] = left
+                else:
+                    self._pending_counts.pop(qq_number, None)
+
+        logger.debug(
+            f"写回缓冲已提交: 消息 {len(messages)} 条, 用户 {len(names)} 个"
+        )
+
+    # ************ 内存用户表 **********
+
+    async def _get_user_registry(self):
+        """获取内存用户表，首次调用时加载最多 user_registry_max_size 个用户"""
+        if self._user_registry is None:
+            max_size = int(self.config.get("user_registry_max_size", 50000))
+            db = await self._get_db()
+            async with self._db_lock:
+                if self._user_registry is None:
+                    sql = (
+                        "SELECT qq_number, name, dialogue_count, last_summarized_count, "
+                        "last_active_at FROM Impression ORDER BY rowid DESC LIMIT ?"
+                    )
+                    async with db.execute(sql, (max_size,)) as cursor:
+                        rows = await cursor.fetchall()
+                    registry = UserRegistry(max_size)
+                    # 倒序插入，使最近入库的用户位于 LRU 的最新端
+                    for row in reversed(rows):
+                        registry.put(*row)
+                    self._user_registry = registry
+                    logger.info(f"内存用户表已预热 {len(rows)} 个用户")
+        return self._user_registry
+
+    async def _record_dialogue_in_registry(self, qq_number, name, user_message, ai_message):
+        """通过内存用户表记录一次对话：只有冷用户需要查库，计数只改内存"""
+        registry = await self._get_user_registry()
+        async with self._user_lock(qq_number):
+            entry = registry.get(qq_number)
+            if entry is None:
+                # 超出容量被淘汰过的老用户，回库里查一次
+                sql = (
+                    "SELECT qq_number, name, dialogue_count, last_summarized_count, "
+                    "last_active_at FROM Impression WHERE qq_number = ?"
+                )
+                async with self._read_conn() as db:
+                    async with db.execute(sql, (qq_number,)) as cursor:
+                        row = await cursor.fetchone()
+                if row:
+                    entry = registry.put(*row)
+
+            if self._write_behind:
+                self._enqueue_write("message", qq_number, (name, user_message, ai_message))
+                if entry is None or entry[0] != name:
+                    self._enqueue_write("user", qq_number, name)
+            else:
+                await self.add_persona_chat_history(qq_number, name, user_message, ai_message)
+                if entry is None:
+                    await self.insert_user(qq_number, name)
+                elif entry[0] != name:
+                    await self.update_user_name_only(qq_number, name)
+
+            if entry is None:
+                entry = registry.put(qq_number, name, 0, 0)
+            entry[0] = name
+            entry[1] += 1
+            # 记下真实的对话时间；其他原因(如总结触发点变化)标脏时不会改动它
+            entry[3] = db_time_now()
+            registry.mark_dirty(qq_number)
+
+    def _registry_should_summarize(self, qq_number, threshold):
+        """距上次触发总结已满 threshold 次对话时返回 True，并记下本次触发点"""
+        entry = self._user_registry.get(qq_number) if self._user_registry else None
+        if entry is None or entry[1] - entry[2] < threshold:
+            return False
+        entry[2] = entry[1]
+        self._user_registry.mark_dirty(qq_number)
+        return True
+
+    async def _registry_flush_loop(self):
+        """后台任务：定期把内存用户表中变化的计数落库"""
+        interval = max(1, int(self.config.get("user_registry_flush_seconds", 30)))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # shield: 卸载时取消任务也不会打断正在进行的落库
+                await asyncio.shield(self.flush_user_registry())
+            except Exception as e:
+                logger.error(f"内存用户表落库失败: {e}")
+
+    @timed("db.flush_user_registry")
+    async def flush_user_registry(self):
+        """把内存用户表中变化的计数批量写入数据库"""
+        if self._user_registry is None:
+            return
+        db = await self._get_db()
+        async with self._db_lock:
+            # 在写锁内取快照，避免与 /osn del 交错而把已删除的用户写回
+            rows = self._user_registry.pop_dirty()
+            if not rows:
+                return
+            try:
+                # upsert: 写回模式下新用户的插入可能还在缓冲中
+                await db.executemany(
+                    "INSERT INTO Impression (qq_number, name, dialogue_count, "
+                    "last_summarized_count, last_active_at) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT(qq_number) DO UPDATE SET "
+                    "dialogue_count = excluded.dialogue_count, "
+                    "last_summarized_count = excluded.last_summarized_count, "
+                    "last_active_at = COALESCE(excluded.last_active_at, Impression.last_active_at)",
+                    rows,
+                )
+                await db.commit()
+                logger.debug(f"内存用户表已落库 {len(rows)} 个用户")
+            except Exception as e:
+                await db.rollback()
+                self._user_registry.requeue(rows)
+                logger.error(f"内存用户表落库失败，稍后重试: {e}")
+
+    # ************ 聊天记录保留策略 **********
+
+    def _retention_enabled(self):
+        return (
+            int(self.config.get("retention_keep_last", 0)) > 0
+            or int(self.config.get("retention_max_days", 0)) > 0
+        )
+
+    async def _retention_loop(self):
+        """后台任务：定期按保留策略归档/删除旧聊天记录"""
+        interval = max(1, int(self.config.get("retention_interval_minutes", 60))) * 60
+        while True:
+            try:
+                await self.run_retention()
+            except Exception as e:
+                logger.error(f"聊天记录清理失败: {e}")
+            await asyncio.sleep(interval)
+
+    @timed("db.run_retention")
+    async def run_retention(self):
+        """
+        保留每个用户最近 N 条和/或 D 天内的聊天记录，其余的归档或删除。
+        两个条件同时设置时，满足任意一个的记录都会保留。
+        按批次执行，每批一个小事务，批次之间让出事件循环，不会长时间占用写锁。
+        """
+        keep_last = int(self.config.get("retention_keep_last", 0))
+        max_days = int(self.config.get("retention_max_days", 0))
+        if keep_last <= 0 and max_days <= 0:
+            return 0
+        if keep_last > 0:
+            # 至少保留总结需要读取的条数
+            keep_last = max(keep_last, int(self.config.get("summary_history_count", 20)))
+        archive = self.config.get("retention_mode", "archive") == "archive"
+        batch_size = max(1, int(self.config.get("retention_batch_size", 500)))
+        age_modifier = f"-{max_days} days"
+
+        db = await self._get_db()
+        if keep_last > 0:
+            sql = "SELECT qq_number FROM Message GROUP BY qq_number HAVING COUNT(*) > ?"
+            params = (keep_last,)
+        else:
+            sql = "SELECT DISTINCT qq_number FROM Message WHERE chat_time < datetime('now', ?)"
+            params = (age_modifier,)
+        # 写连接上的查询也在写锁内执行：不会读到其他协程未提交的写入，也不会被维护任务的超时中断
+        async with self._db_lock:
+            async with db.execute(sql, params) as cursor:
+                users = [row[0] for row in await cursor.fetchall()]
+
+        total = 0
+        for qq_number in users:
+            # 还没总结过的记录不清理，清理范围不超过该用户的总结水位
+            conditions = ["qq_number = ?", "id <= ?"]
+            async with self._db_lock:
+                async with db.execute(
+                    "SELECT COALESCE(last_summarized_message_id, 0) FROM Impression "
+                    "WHERE qq_number = ?",
+                    (qq_number,),
+                ) as cursor:
+                    watermark = await cursor.fetchone()
+                boundary = None
+                if keep_last > 0:
+                    # 第 N 新的记录 id，比它旧的才可能被清理
+                    sql = "SELECT id FROM Message WHERE qq_number = ? ORDER BY id DESC LIMIT 1 OFFSET ?"
+                    async with db.execute(sql, (qq_number, keep_last - 1)) as cursor:
+                        boundary = await cursor.fetchone()
+            if not watermark or watermark[0] <= 0 or (keep_last > 0 and not boundary):
+                continue
+            params = [qq_number, watermark[0]]
+            if boundary:
+                conditions.append("id < ?")
+                params.append(boundary[0])
+            if max_days > 0:
+                conditions.append("chat_time < datetime('now', ?)")
+                params.append(age_modifier)
+
+            select_sql = (
+                f"SELECT id, chat_time, {self.MESSAGE_COLUMNS} FROM Message WHERE "
+                + " AND ".join(conditions)
+                + " ORDER BY id LIMIT ?"
+            )
+            while True:
+                async with self._db_lock:
+                    async with db.execute(select_sql, (*params, batch_size)) as cursor:
+                        rows = await cursor.fetchall()
+                    if not rows:
+                        break
+                    texts = await self._decode_messages([row[2:] for row in rows])
+
+                    try:
+                        if archive:
+                            # 归档中保存整段文本，与存储格式无关
+                            payload = zlib.compress(
+                                json.dumps(
+                                    [[row[0], row[1], text] for row, text in zip(rows, texts)],
+                                    ensure_ascii=False,
+                                ).encode("utf-8")
+                            )
+                            await db.execute(
+                                "INSERT INTO MessageArchive (qq_number, first_message_id, "
+                                "last_message_id, message_count, payload) VALUES (?, ?, ?, ?, ?)",
+                                (qq_number, rows[0][0], rows[-1][0], len(rows), payload),
+                            )
+                        await self._fts_delete_compact(
+                            db, [(row[0], text) for row, text in zip(rows, texts) if row[2] is None]
+                        )
+                        await db.executemany(
+                            "DELETE FROM Message WHERE id = ?", [(row[0],) for row in rows]
+                        )
+                        await db.commit()
+                    except asyncio.CancelledError:
+                        # 卸载时被取消：撤销这一批未提交的修改，不留下半个事务
+                        await db.rollback()
+                        raise
+                    except Exception as e:
+                        await db.rollback()
+                        logger.error(f"清理用户 {qq_number} 的聊天记录失败: {e}")
+                        break
+
+                total += len(rows)
+                if len(rows) < batch_size:
+                    break
+                # 批次之间让出事件循环，避免阻塞聊天写入
+                await asyncio.sleep(0)
+
+        if total:
+            logger.info(f"聊天记录保留策略：已{'归档' if archive else '删除'} {total} 条旧记录")
+        return total
+
+    # ************ 数据库维护 **********
+
+    async def _maintenance_loop(self):
+        """后台任务：每隔一段时间，在聊天空闲时做一次数据库维护"""
+        interval = max(1, int(self.config.get("maintenance_interval_minutes", 30))) * 60
+        idle = max(0, int(self.config.get("maintenance_idle_seconds", 60)))
+        while True:
+            await asyncio.sleep(interval)
+            # 等到连续 idle 秒没有聊天再开始
+            while (quiet := time.monotonic() - self._last_activity) < idle:
+                await asyncio.sleep(idle - quiet)
+            try:
+                await self.run_maintenance()
+            except Exception as e:
+                logger.error(f"数据库维护失败: {e}")
+
+    @contextlib.asynccontextmanager
+    async def _time_limit(self, db, budget_ms):
+        """限制期间执行的 SQL 不超过 budget_ms：超时的语句被中断，等锁也最多等这么久"""
+        deadline = time.monotonic() + budget_ms / 1000
+        await db.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        await db.execute(f"PRAGMA busy_timeout = {int(budget_ms)}")
+        try:
+            yield
+        finally:
+            await db.set_progress_handler(None, 0)
+            busy_timeout = max(0, int(self.config.get("sqlite_busy_timeout_ms", 5000)))
+            await db.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+
+    async def run_maintenance(self):
+        """依次执行 PRAGMA optimize、增量 VACUUM、WAL 检查点，每一步都有时间上限，返回各步结果
+
+        时间上限装在写连接上，只有读操作走只读连接池时才能保证不影响其他请求，否则不执行
+        """
+        budget_ms = max(10, int(self.config.get("maintenance_time_budget_ms", 200)))
+        db = await self._get_db()
+        if self._read_pool is None:
+            return {}
+        results = {}
+
+        async def step(name, sql, script=False):
+            async with self._db_lock:
+                try:
+                    async with self._time_limit(db, budget_ms):
+                        with self.metrics.timer(f"maintenance.{name}"):
+                            if script:
+                                # incremental_vacuum 每一步只归还一页，execute 只会执行一步
+                                await db.executescript(sql)
+                                rows = []
+                            else:
+                                async with db.execute(sql) as cursor:
+                                    rows = await cursor.fetchall()
+                    results[name] = rows[0] if rows else None
+                    return results[name]
+                except Exception as e:
+                    # 超时被中断或拿不到锁：本轮跳过，下一轮再试
+                    self.metrics.incr("maintenance.interrupted")
+                    results[name] = f"跳过: {e}"
+                    return None
+
+        # 只分析统计信息可能过时的表(采样行数由 analysis_limit 限制)
+        await step("optimize", "PRAGMA optimize")
+
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            auto_vacuum = (await cursor.fetchone())[0]
+        if auto_vacuum == 2:
+            pages = max(1, int(self.config.get("maintenance_vacuum_pages", 256)))
+            freed = 0
+            # 每次归还一小批空闲页，之间让出写锁；有新的聊天就停下
+            while time.monotonic() - self._last_activity >= 1:
+                async with db.execute("PRAGMA freelist_count") as cursor:
+                    free = (await cursor.fetchone())[0]
+                if free == 0:
+                    break
+                await step(
+                    "incremental_vacuum", f"PRAGMA incremental_vacuum({min(free, pages)});", True
+                )
+                if isinstance(results["incremental_vacuum"], str):
+                    break
+                async with db.execute("PRAGMA freelist_count") as cursor:
+                    left = (await cursor.fetchone())[0]
+                if left >= free:
+                    break
+                freed += free - left
+                await asyncio.sleep(0)
+            results["incremental_vacuum"] = freed
+            self.metrics.incr("maintenance.pages_freed", freed)
+
+        # TRUNCATE 在没有读事务时把 WAL 写回主库并截断为 0 字节
+        await step("wal_checkpoint", "PRAGMA wal_checkpoint(TRUNCATE)")
+        self.metrics.incr("maintenance.runs")
+        logger.info(f"数据库维护完成: {results}")
+        return results
+
+    # ************ 全文搜索 **********
+
+    async def _load_fts_state(self, db):
+        async with db.execute(
+            "SELECT key, value FROM PluginMeta WHERE key IN ('fts_tokenizer', 'fts_backfill_upto')"
+        ) as cursor:
+            meta = dict(await cursor.fetchall())
+        self._fts_tokenizer = meta.get("fts_tokenizer") or ""
+        self._fts_backfill_upto = int(meta.get("fts_backfill_upto") or 0)
+
+    async def _fts_backfill_loop(self):
+        """从新到旧分批把已有聊天记录加入全文索引，每批一个小事务"""
+        batch_size = max(1, int(self.config.get("fts_backfill_batch_size", 500)))
+        try:
+            while self._fts_backfill_upto > 0:
+                await self.fts_backfill_batch(batch_size)
+                await asyncio.sleep(0.05)  # 让出写锁给聊天流程
+            logger.info("聊天记录全文索引补建完成")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"补建全文索引失败: {e}")
+        finally:
+            self._fts_task = None
+
+    async def fts_backfill_batch(self, batch_size):
+        """补建一批索引，返回本批条数"""
+        db = await self._get_db()
+        async with self._db_lock:
+            upto = self._fts_backfill_upto
+            try:
+                sql = (
+                    "SELECT MIN(id), COUNT(*) FROM "
+                    "(SELECT id FROM Message WHERE id <= ? ORDER BY id DESC LIMIT ?)"
+                )
+                async with db.execute(sql, (upto, batch_size)) as cursor:
+                    low, count = await cursor.fetchone()
+                new_upto = (low - 1) if count else 0
+                if count:
+                    await db.execute(
+                        "INSERT INTO MessageFTS (rowid, message) SELECT id, message "
+                        "FROM Message WHERE id BETWEEN ? AND ? AND message IS NOT NULL",
+                        (low, upto),
+                    )
+                    async with db.execute(
+                        f"SELECT id, {self.MESSAGE_COLUMNS} FROM Message "
+                        "WHERE id BETWEEN ? AND ? AND message IS NULL",
+                        (low, upto),
+                    ) as cursor:
+                        compact = await cursor.fetchall()
+                    if compact:
+                        texts = await self._decode_messages([row[1:] for row in compact])
+                        await db.executemany(
+                            "INSERT INTO MessageFTS (rowid, message) VALUES (?, ?)",
+                            [(row[0], text) for row, text in zip(compact, texts)],
+                        )
+                # 水位与索引在同一事务中更新，触发器据此判断哪些记录已在索引中
+                await db.execute(
+                    "UPDATE PluginMeta SET value = ? WHERE key = 'fts_backfill_upto'",
+                    (str(new_upto),),
+                )
+                await db.commit()
+                self._fts_backfill_upto = new_upto
+                self.metrics.incr("fts.backfilled", count)
+                return count
+            except BaseException:
+                # 包括卸载时的取消：未提交的一批不能留在写连接上
+                await db.rollback()
+                raise
+
+    # ************ 紧凑存储迁移 **********
+
+    async def _compact_migration_loop(self):
+        """把旧格式的聊天记录从旧到新分批转为紧凑格式，每批一个小事务"""
+        batch_size = max(1, int(self.config.get("compact_migration_batch_size", 500)))
+        try:
+            while await self.compact_messages_batch(batch_size):
+                await asyncio.sleep(0.05)  # 让出写锁给聊天流程
+            logger.info("旧聊天记录已迁移为紧凑存储格式")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"迁移聊天记录存储格式失败: {e}")
+        finally:
+            self._compact_task = None
+
+    async def compact_messages_batch(self, batch_size):
+        """迁移一批旧格式记录，返回本批检查的条数；拆不开的记录保持原样"""
+        db = await self._get_db()
+        async with self._db_lock:
+            sql = (
+                "SELECT id, message FROM Message WHERE id > ? AND message IS NOT NULL "
+                "ORDER BY id LIMIT ?"
+            )
+            async with db.execute(sql, (self._compact_upto, batch_size)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                return 0
+
+            ai_names = [self.config.get("personas_name", "AI助手")]
+            threshold = int(self.config.get("message_compress_threshold", 512))
+            codec = self.config.get("message_compression", "zlib")
+            updates, new_speakers = [], {}
+            try:
+                for message_id, message in rows:
+                    parts = split_message(message, ai_names)
+                    if parts is None:
+                        continue
+                    user_name, user_text, ai_name, ai_text = parts
+                    updates.append((
+                        encode_body(user_text, threshold, codec),
+                        encode_body(ai_text, threshold, codec),
+                        await self._speaker_id(db, user_name, new_speakers),
+                        await self._speaker_id(db, ai_name, new_speakers),
+                        message_id,
+                    ))
+                # 内容不变，全文索引中的记录无需改动(更新触发器会跳过 message 置空的情况)
+                await db.executemany(
+                    "UPDATE Message SET message = NULL, user_text = ?, ai_text = ?, "
+                    "speaker_id = ?, ai_speaker_id = ? WHERE id = ?",
+                    updates,
+                )
+                new_upto = rows[-1][0]
+                await db.execute(
+                    "UPDATE PluginMeta SET value = ? WHERE key = 'compact_migrated_upto'",
+                    (str(new_upto),),
+                )
+                await db.commit()
+            except BaseException:
+                # 包括卸载时的取消：未提交的一批不能留在写连接上
+                await db.rollback()
+                raise
+            self._remember_speakers(new_speakers)
+            self._compact_upto = new_upto
+            self.metrics.incr("storage.migrated", len(updates))
+            if len(updates) < len(rows):
+                self.metrics.incr("storage.migrate_skipped", len(rows) - len(updates))
+            return len(rows)
+
+    async def _fts_delete_compact(self, db, rows):
+        """删除紧凑格式的记录前，先从全文索引中移除 [(id, 整段文本)]；触发器只能处理整段文本的记录"""
+        rows = [row for row in rows if row[0] > self._fts_backfill_upto]
+        if self._fts_tokenizer and rows:
+            await db.executemany(
+                "INSERT INTO MessageFTS (MessageFTS, rowid, message) VALUES ('delete', ?, ?)",
+                rows,
+            )
+
+    @staticmethod
+    def _fts_query(terms):
+        """把关键词转成 FTS5 短语查询，双引号转义，避免用户输入被当作查询语法"""
+        return [
+            '"' + term.replace('"', '""') + '"' for term in terms if term
+        ]
+
+    @timed("db.search_messages")
+    async def search_messages(self, keyword, qq_number=None, limit=10, before_id=None):
+        """全文搜索聊天记录，按相关度返回 [(id, qq_number, chat_time, 摘要片段)]"""
+        terms = keyword.split()
+        if not self._fts_tokenizer or not terms:
+            return []
+        # trigram 索引至少需要 3 个字符，更短的词在匹配结果内再用 instr 过滤
+        short_terms = []
+        if self._fts_tokenizer == "trigram":
+            short_terms = [t for t in terms if len(t) < 3]
+            terms = [t for t in terms if len(t) >= 3]
+
+        conditions, params = [], []
+        if terms:
+            conditions.append("MessageFTS MATCH ?")
+            params.append(" ".join(self._fts_query(terms)))
+        for term in short_terms:
+            # 紧凑格式的记录正文不在 message 列中，解压后再过滤
+            conditions.append("(m.message IS NULL OR instr(m.message, ?) > 0)")
+            params.append(term)
+        if qq_number:
+            conditions.append("m.qq_number = ?")
+            params.append(qq_number)
+        if before_id is not None:
+            conditions.append("m.id <= ?")
+            params.append(before_id)
+
+        columns = self._message_columns("m")
+        # 紧凑记录要解压后才能按短词过滤，SQL 放行的候选可能被滤掉，需要分页取到够数或取完为止
+        page_size = limit * 4 if short_terms and self._speaker_names else limit
+        results = []
+        offset, last_id = 0, None
+        while len(results) < limit:
+            if terms:
+                sql = (
+                    "SELECT m.id, m.qq_number, m.chat_time, "
+                    f"snippet(MessageFTS, 0, '【', '】', '…', 24), {columns} "
+                    "FROM MessageFTS JOIN Message m ON m.id = MessageFTS.rowid "
+                    f"WHERE {' AND '.join(conditions)} ORDER BY rank LIMIT ? OFFSET ?"
+                )
+                page_params = [*params, page_size, offset]
+            else:
+                # 只有短词时无法使用索引，按 id 倒序逐页扫描，直到凑够结果或扫完全部记录
+                page_conditions = list(conditions)
+                page_params = list(params)
+                if last_id is not None:
+                    page_conditions.append("m.id < ?")
+                    page_params.append(last_id)
+                sql = (
+                    f"SELECT m.id, m.qq_number, m.chat_time, substr(m.message, 1, 120), {columns} "
+                    f"FROM Message m WHERE {' AND '.join(page_conditions)} "
+                    "ORDER BY m.id DESC LIMIT ?"
+                )
+                page_params.append(page_size)
+
+            async with self._read_conn() as db:
+                async with db.execute(sql, page_params) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                break
+            offset += len(rows)
+            last_id = rows[-1][0]
+
+            compact = [row for row in rows if row[4] is None]
+            texts = await self._decode_messages([row[4:] for row in compact])
+            texts = {row[0]: text for row, text in zip(compact, texts)}
+            for row in rows:
+                text = texts.get(row[0])
+                if text is None:
+                    results.append(row[:4])
+                elif all(term in text for term in short_terms):
+                    # 外部内容表取不到紧凑记录的正文，摘要在这里生成
+                    snippet = self._snippet(text, terms + short_terms) if terms else text[:120]
+                    results.append((*row[:3], snippet))
+            if len(rows) < page_size:
+                break
+        return results[:limit]
+
+    def _message_columns(self, alias):
+        return ", ".join(f"{alias}.{column}" for column in self.MESSAGE_COLUMNS.split(", "))
+
+    @staticmethod
+    def _snippet(text, terms, width=24):
+        """与 FTS5 snippet() 相同格式的摘要：命中词用【】标出，截断处用 … 表示"""
+        lowered = text.lower()
+        for term in terms:
+            pos = lowered.find(term.lower())
+            if pos >= 0:
+                break
+        else:
+            return text[:width] + ("…" if len(text) > width else "")
+        start = max(0, pos - width // 2)
+        end = min(len(text), pos + len(term) + width // 2)
+        return (
+            ("…" if start > 0 else "")
+            + text[start:pos]
+            + "【" + text[pos : pos + len(term)] + "】"
+            + text[pos + len(term) : end]
+            + ("…" if end < len(text) else "")
+        )
+
+    def _related_terms(self, messages, exclude, limit=8):
+        """从新消息中取出现次数最多的若干词(中文按三字切分)，用于检索相关的早期对话"""
+        counts = {}
+        for text in messages:
+            for run in re.findall(r"[\u4e00-\u9fff]{3,}|[A-Za-z0-9]{3,}", text):
+                if run.isascii():
+                    grams = [run.lower()]
+                else:
+                    grams = [run[i : i + 3] for i in range(len(run) - 2)]
+                for gram in grams:
+                    if not any(gram in name for name in exclude):
+                        counts[gram] = counts.get(gram, 0) + 1
+        return sorted(counts, key=counts.get, reverse=True)[:limit]
+
+    async def get_related_history(self, qq_number, user_name, messages, before_id, n):
+        """按新消息的内容检索该用户 before_id 及之前最相关的 n 条聊天记录"""
+        if not self._fts_tokenizer or n <= 0 or before_id <= 0:
+            return []
+        exclude = (user_name, self.config.get("personas_name", "AI助手"))
+        terms = self._related_terms(messages, exclude)
+        if self._fts_tokenizer == "trigram":
+            terms = [t for t in terms if len(t) >= 3]
+        if not terms:
+            return []
+        sql = (
+            f"SELECT m.id, {self._message_columns('m')} "
+            "FROM MessageFTS JOIN Message m ON m.id = MessageFTS.rowid "
+            "WHERE MessageFTS MATCH ? AND m.qq_number = ? AND m.id <= ? ORDER BY rank LIMIT ?"
+        )
+        try:
+            async with self._read_conn() as db:
+                params = (" OR ".join(self._fts_query(terms)), qq_number, before_id, n)
+                async with db.execute(sql, params) as cursor:
+                    rows = await cursor.fetchall()
+            return await self._decode_messages([row[1:] for row in sorted(rows)])
+        except Exception as e:
+            logger.error(f"检索相关聊天记录失败: {e}")
+            return []
+
     # ************ 事件处理函数 **********
 
     @filter.on_llm_request()
+    @timed("hook.on_llm_request", routed=True)
     async def inject_dynamic_persona(
         self, event: AstrMessageEvent, req: ProviderRequest
     ):
+        shard = self._route(event)
+        if shard is not self:
+            return await shard.inject_dynamic_persona(event, req)
+        self._last_activity = time.monotonic()
+
         current_session_id = str(event.get_session_id())  # 6. 强转字符串
 
         # 6. 配置项强转字符串进行比对
@@ -269,20 +2589,39 @@ class PersonaFlow(Star):
                 logger.warning("人格配置缺失")
                 return
 
-            # 缓存未命中，查库
+            # 会话模式：{Impression} 只包含当前会话最近的发言者
+            if self.config.get("impression_scope", "global") == "session":
+                participants = self._track_participant(
+                    current_session_id, event.get_sender_id()
+                )
+                template = self._get_template(json_persona_id)
+                if template is not None and template.prompt:
+                    session_impression = await self.get_session_impression(participants)
+                    req.system_prompt = self._render_template(template, session_impression)
+                    self._record_prompt_prefix(current_session_id, req.system_prompt)
+                return
+
+            # 优先命中内存缓存，版本变化时才查库
             target_dynamic_id = json_persona_id + "动态"
             dynamic_prompt = await self.get_dynamic_persona(target_dynamic_id)
             # logger.info(f"使用的system prompt:{dynamic_prompt}")
 
             if dynamic_prompt:
                 req.system_prompt = dynamic_prompt
+                self._record_prompt_prefix(target_dynamic_id, dynamic_prompt)
                 # logger.debug(f"已应用动态人格: {target_dynamic_id}")
             else:
                 # 第一次运行时可能没有动态人格，此时不做操作，让AstrBot使用默认加载的
                 pass
 
     @filter.on_llm_response()
+    @timed("hook.on_llm_response", routed=True)
     async def on_llm_response(self, event: AstrMessageEvent, resp: LLMResponse):
+        shard = self._route(event)
+        if shard is not self:
+            return await shard.on_llm_response(event, resp)
+        self._last_activity = time.monotonic()
+
         # 获取当前会话id
         current_session_id = str(event.get_session_id())
 
@@ -308,37 +2647,56 @@ class PersonaFlow(Star):
                 if not user_message or not resp.completion_text:
                     return
 
-                message = self.merge_AI_and_user_message(
-                    user_message, resp.completion_text, new_name
-                )
-
-                # 1. 先存聊天记录
-                await self.add_persona_chat_history(qq_number, message)
-
-                # 2. 检查用户是否存在
-                user_exists = False
-                db_name = None
+                ai_message = resp.completion_text
 
-                # 直接操作 db 避免反复获取连接
-                db = await self._get_db()
-                sql = "SELECT name FROM Impression WHERE qq_number = ?"
-                async with db.execute(sql, (qq_number,)) as cursor:
-                    result = await cursor.fetchone()
-                    if result:
-                        user_exists = True
-                        db_name = result[0]
-
-                # 3. 读写分离逻辑
-                if user_exists:
-                    # 用户存在，检查是否改名
-                    if new_name != db_name:
-                        await self.update_user_name_only(qq_number, new_name)
+                if self._registry_enabled:
+                    # 内存用户表：存在性、改名和计数判断都不查库
+                    await self._record_dialogue_in_registry(
+                        qq_number, new_name, user_message, ai_message
+                    )
+                elif self._write_behind:
+                    # 写回模式：只入队，由后台任务合并提交
+                    self._enqueue_write(
+                        "message", qq_number, (new_name, user_message, ai_message)
+                    )
+                    self._enqueue_write("user", qq_number, new_name)
+                    self._enqueue_write("count", qq_number)
                 else:
-                    # 用户不存在，插入
-                    await self.insert_user(qq_number, new_name)
+                    # 同一用户的"查询-插入/改名-计数"需要串行，不同用户互不等待
+                    async with self._user_lock(qq_number):
+                        # 1. 先存聊天记录
+                        await self.add_persona_chat_history(
+                            qq_number, new_name, user_message, ai_message
+                        )
 
-                # 4. 增加对话次数
-                await self.increment_dialogue_count(qq_number)
+                        # 2. 检查用户是否存在
+                        user_exists = False
+                        db_name = None
+
+                        # 走只读连接，不占用写连接
+                        sql = "SELECT name FROM Impression WHERE qq_number = ?"
+                        async with self._read_conn() as db:
+                            async with db.execute(sql, (qq_number,)) as cursor:
+                                result = await cursor.fetchone()
+                                if result:
+                                    user_exists = True
+                                    db_name = result[0]
+
+                        # 3. 读写分离逻辑
+                        if user_exists:
+                            # 用户存在，检查是否改名
+                            if new_name != db_name:
+                                await self.update_user_name_only(qq_number, new_name)
+                        else:
+                            # 用户不存在，插入
+                            await self.insert_user(qq_number, new_name)
+
+                        # 4. 增加对话次数
+                        await self.increment_dialogue_count(qq_number)
+
+                # 更新内存中的活跃信息，供印象预算排序使用
+                if self._impression_block is not None:
+                    self._impression_block.touch(qq_number)
 
             except Exception as e:
                 logger.error(f"处理用户数据失败: {e}", exc_info=True)
@@ -353,29 +2711,29 @@ class PersonaFlow(Star):
                     "summary_trigger_threshold", 5
                 )
                 qq_number = event.get_sender_id()
-                dialogue_count = await self.select_dialogue_count(qq_number)
-
-                if (
-                    dialogue_count > 0
-                    and dialogue_count % summary_trigger_threshold == 0
-                ):
-                    # 获取之前的印象文本
-                    await self.get_sql_relationship_impression()
-
-                    # 执行 LLM 总结
-                    summary_result = await self.llm_summary(
-                        event, new_name, qq_number, json_persona_id
+                if self._cadence is not None:
+                    should_summarize = await self._cadence_should_summarize(
+                        event.unified_msg_origin,
+                        new_name,
+                        qq_number,
+                        len(user_message) + len(ai_message),
+                    )
+                elif self._registry_enabled:
+                    should_summarize = self._registry_should_summarize(
+                        qq_number, summary_trigger_threshold
+                    )
+                else:
+                    dialogue_count = await self.select_dialogue_count(qq_number)
+                    should_summarize = (
+                        dialogue_count > 0
+                        and dialogue_count % summary_trigger_threshold == 0
                     )
 
-                    # 如果总结成功（返回了字符串），则更新 System Prompt
-                    if summary_result:
-                        # 重新获取最新的完整印象列表（包含刚更新的）
-                        new_full_impression = (
-                            await self.get_sql_relationship_impression()
-                        )
-                        await self.write_astrbot_persona_prompt(
-                            json_persona_id, new_full_impression
-                        )
+                if should_summarize:
+                    # 只入队，由后台 worker 执行总结
+                    self._schedule_summary(
+                        event.unified_msg_origin, new_name, qq_number, json_persona_id
+                    )
 
             except Exception as e:
                 logger.error(f"总结触发流程失败: {e}")
@@ -383,36 +2741,417 @@ class PersonaFlow(Star):
             logger.info("当前会话不在设置，未执行代码")
             pass
 
-    async def llm_summary(
-        self, event: AstrMessageEvent, user, qq_number, json_persona_id
-    ):
+    # ************ 总结调度 **********
+
+    async def _cadence_should_summarize(self, umo, user, qq_number, chars):
+        """自适应节奏：记录一轮对话，返回是否触发总结"""
+        newcomer = False
+        if qq_number not in self._cadence:
+            newcomer = await self.select_dialogue_count(qq_number) <= self._cadence.base
+        reason = self._cadence.record(
+            qq_number, chars, (umo, user), newcomer, qq_number in self._summary_jobs
+        )
+        if reason is None:
+            return False
+        self.metrics.incr(f"cadence.{reason}")
+        if reason == "capped":
+            return False
+        entry = self._user_registry.get(qq_number) if self._user_registry else None
+        if entry is not None:
+            # 与固定间隔共用触发点，关闭自适应后不会立刻重复触发
+            entry[2] = entry[1]
+            self._user_registry.mark_dirty(qq_number)
+        return True
+
+    def _cadence_feedback(self, qq_number, before, after):
+        """总结完成后按结果是否变化调整该用户的间隔"""
+        if self._cadence is None:
+            return
+        interval = self._cadence.feedback(qq_number, before, after)
+        if interval is not None:
+            self.metrics.observe("cadence.interval", interval)
+
+    async def _cadence_idle_loop(self):
+        """后台任务：用户长时间不说话时，把还没总结的对话补上"""
+        idle = max(1, int(self.config.get("summary_idle_seconds", 600)))
+        while True:
+            await asyncio.sleep(max(5, min(60, idle / 4)))
+            try:
+                persona_id = self.config.get("personas_name", "")
+                for qq_number, (umo, user) in self._cadence.idle_due(idle):
+                    self.metrics.incr("cadence.idle")
+                    self._schedule_summary(umo, user, qq_number, persona_id)
+            except Exception as e:
+                logger.error(f"空闲总结检查失败: {e}")
+
+    def _schedule_summary(self, umo, user, qq_number, persona_id):
+        """提交总结任务；同一用户已在排队时只更新参数，不重复入队"""
+        coalesced = qq_number in self._summary_jobs
+        self._summary_jobs[qq_number] = {
+            "umo": umo,
+            "user": user,
+            "qq_number": qq_number,
+            "persona_id": persona_id,
+        }
+
+        concurrency = max(1, int(self.config.get("summary_concurrency", 2)))
+        self._summary_workers = [w for w in self._summary_workers if not w.done()]
+        while len(self._summary_workers) < concurrency:
+            self._summary_workers.append(asyncio.create_task(self._summary_worker()))
+
+        # 正在总结的用户由 worker 完成后重新入队
+        if not coalesced and qq_number not in self._summary_running:
+            self._summary_queue.put_nowait(qq_number)
+
+        logger.info(
+            f"总结任务{'已合并' if coalesced else '已入队'}: {user}({qq_number})，"
+            f"排队 {self._summary_queue.qsize()}，执行中 {len(self._summary_running)}"
+        )
+
+    # /osn queue 最多列出的等待用户数
+    QUEUE_DISPLAY_LIMIT = 20
+
+    def summary_queue_status(self):
+        """总结队列状态：排队数、执行中数量、等待总数和最早的若干个等待用户"""
+        return {
+            "queued": self._summary_queue.qsize(),
+            "in_flight": len(self._summary_running),
+            "deferred": len(self._summary_deferred),
+            "pending": len(self._summary_jobs),
+            "pending_users": list(itertools.islice(self._summary_jobs, self.QUEUE_DISPLAY_LIMIT)),
+        }
+
+    async def _summary_worker(self):
+        """后台 worker：取出用户执行总结并刷新动态人格，开启合并时一次取出多个"""
+        while True:
+            qq_numbers = [await self._summary_queue.get()]
+
+            batch_size = int(self.config.get("summary_batch_size", 1))
+            if batch_size > 1:
+                # 等待一个窗口，把短时间内达到阈值的用户合并为一次请求
+                window_ms = max(0, int(self.config.get("summary_batch_window_ms", 500)))
+                await asyncio.sleep(window_ms / 1000)
+                while len(qq_numbers) < batch_size and not self._summary_queue.empty():
+                    qq_numbers.append(self._summary_queue.get_nowait())
+
+            jobs = []
+            for qq_number in qq_numbers:
+                job = self._summary_jobs.pop(qq_number, None)
+                if job is not None:
+                    jobs.append(job)
+                    self._summary_running.add(qq_number)
+
+            done = set()  # 本轮已完成的 qq_number，熔断时不再推迟重跑
+            try:
+                if len(jobs) == 1:
+                    await self._run_summary_job(jobs[0])
+                elif jobs:
+                    await self._run_summary_batch(jobs, done)
+            except SummaryDeferred as e:
+                self._defer_summary(
+                    [job for job in jobs if job["qq_number"] not in done], e.retry_after
+                )
+            except Exception as e:
+                logger.error(f"总结任务执行失败: {e}")
+            finally:
+                for qq_number in qq_numbers:
+                    self._summary_running.discard(qq_number)
+                    # 总结期间又被触发，重新排队一次(推迟中的任务由定时器重新排队)
+                    if (
+                        qq_number in self._summary_jobs
+                        and qq_number not in self._summary_deferred
+                    ):
+                        self._summary_queue.put_nowait(qq_number)
+                    self._summary_queue.task_done()
+
+    def _defer_summary(self, jobs, delay):
+        """熔断期间不丢弃任务：放回待总结表，冷却结束后重新排队"""
+        loop = asyncio.get_running_loop()
+        for job in jobs:
+            qq_number = job["qq_number"]
+            # 推迟期间又被触发时保留最新的参数
+            self._summary_jobs.setdefault(qq_number, job)
+            handle = self._summary_deferred.pop(qq_number, None)
+            if handle is not None:
+                handle.cancel()
+            # 加一点随机抖动，避免冷却结束时所有用户同时重试
+            self._summary_deferred[qq_number] = loop.call_later(
+                delay * random.uniform(1.0, 1.1), self._resume_summary, qq_number
+            )
+        self.metrics.incr("summary.deferred", len(jobs))
+        logger.warning(f"总结已熔断，{len(jobs)} 个用户推迟约 {delay:.0f} 秒后重试")
+
+    def _resume_summary(self, qq_number):
+        self._summary_deferred.pop(qq_number, None)
+        if qq_number in self._summary_jobs and qq_number not in self._summary_running:
+            self._summary_queue.put_nowait(qq_number)
+
+    def _backoff_delay(self, attempt):
+        """第 attempt 次重试前的等待秒数：指数退避，带 ±50% 随机抖动"""
+        base = max(0, int(self.config.get("summary_backoff_base_ms", 1000))) / 1000
+        cap = max(0, int(self.config.get("summary_backoff_max_ms", 30000))) / 1000
+        return min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    async def _call_summary_llm(self, provider_id, system_prompt, prompt, json_mode=False):
+        """经过熔断器和令牌桶调用大模型，熔断中抛出 SummaryDeferred
+
+        json_mode 为真且开启了 summary_json_mode 时，请求模型以 JSON 对象格式输出；
+        模型不支持时自动退回普通输出，并记住该模型
+        """
+        breaker = self._breakers.get(provider_id)
+        if breaker is None:
+            breaker = self._breakers[provider_id] = CircuitBreaker(
+                int(self.config.get("summary_breaker_threshold", 5)),
+                max(1, int(self.config.get("summary_breaker_cooldown_seconds", 60))),
+            )
+        if not breaker.allow():
+            raise SummaryDeferred(breaker.remaining())
+
+        rate = float(self.config.get("summary_rate_limit_per_minute", 60)) / 60
+        if rate > 0:
+            bucket = self._rate_limiters.get(provider_id)
+            if bucket is None:
+                bucket = self._rate_limiters[provider_id] = TokenBucket(
+                    rate, float(self.config.get("summary_rate_burst", 10))
+                )
+            with self.metrics.timer("summary.rate_wait"):
+                await bucket.acquire()
+
+        kwargs = {}
+        if (
+            json_mode
+            and self.config.get("summary_json_mode", False)
+            and provider_id not in self._json_mode_unsupported
+        ):
+            kwargs["response_format"] = {"type": "json_object"}
+
+        try:
+            with self.metrics.timer("summary.llm_call"):
+                try:
+                    llm_resp = await self.context.llm_generate(
+                        chat_provider_id=provider_id,
+                        system_prompt=system_prompt,
+                        prompt=prompt,
+                        **kwargs,
+                    )
+                except TypeError as e:
+                    if not kwargs or "response_format" not in str(e):
+                        raise
+                    self._json_mode_unsupported.add(provider_id)
+                    self.metrics.incr("summary.json_mode_unsupported")
+                    logger.info(f"模型 {provider_id} 不支持 JSON 输出模式，改用普通输出")
+                    llm_resp = await self.context.llm_generate(
+                        chat_provider_id=provider_id,
+                        system_prompt=system_prompt,
+                        prompt=prompt,
+                    )
+        except Exception:
+            if breaker.record_failure():
+                self.metrics.incr("summary.breaker_open")
+                logger.warning(
+                    f"模型 {provider_id} 连续 {breaker.failures} 次调用失败，"
+                    f"暂停总结 {breaker.cooldown} 秒"
+                )
+            raise
+        breaker.record_success()
+        return llm_resp
+
+    async def _run_summary_job(self, job):
+        """执行一次总结，成功后重建动态人格 Prompt"""
+        persona_id = job["persona_id"]
+        summary_result = await self.llm_summary(
+            job["umo"], job["user"], job["qq_number"], persona_id
+        )
+
+        # 如果总结成功（返回了字符串），则更新 System Prompt
+        if summary_result:
+            # 串行化，避免并发的总结用旧的印象列表覆盖新的
+            async with self._persona_write_lock:
+                new_full_impression = await self.get_sql_relationship_impression()
+                await self.write_astrbot_persona_prompt(persona_id, new_full_impression)
+
+    async def _run_summary_batch(self, jobs, done):
+        """合并总结多个用户；同一人格、同一模型的用户才能放进同一次请求
+
+        每完成一个用户就把 qq_number 加入 done，中途熔断时只推迟还没完成的用户
+        """
+        groups = {}
+        for job in jobs:
+            provider_id = await self.context.get_current_chat_provider_id(umo=job["umo"])
+            groups.setdefault((job["persona_id"], provider_id), []).append(job)
+
+        for (persona_id, provider_id), group in groups.items():
+            if len(group) == 1:
+                await self._run_summary_job(group[0])
+                done.add(group[0]["qq_number"])
+                continue
+
+            failed = await self.llm_summary_batch(provider_id, persona_id, group)
+            failed_ids = {job["qq_number"] for job in failed}
+            done.update(job["qq_number"] for job in group if job["qq_number"] not in failed_ids)
+            if len(failed) < len(group):
+                async with self._persona_write_lock:
+                    new_full_impression = await self.get_sql_relationship_impression()
+                    await self.write_astrbot_persona_prompt(persona_id, new_full_impression)
+
+            # 合并结果中缺失或不合格的用户，退回逐个总结
+            for job in failed:
+                await self._run_summary_job(job)
+                done.add(job["qq_number"])
+
+    async def llm_summary_batch(self, provider_id, json_persona_id, jobs):
+        """一次请求总结多个用户，返回需要单独重试的任务"""
+        logger.info(f"开始合并总结 {len(jobs)} 个用户")
+
+        if self._write_behind:
+            await self.flush_write_buffer()
+
+        summary_history_count = self.config.get("summary_history_count", 20)
+        sections = []
+        watermarks = {}
+        priors = {}  # qq_number -> 总结前的 (关系, 印象)
+        for job in jobs:
+            # 每位用户只带自己的旧印象和水位之后的新消息
+            rel, imp, after_id = await self.get_summary_state(job["qq_number"])
+            history, _, last_id = await self.get_chat_history_since(
+                job["qq_number"], after_id, summary_history_count
+            )
+            if not history:
+                continue
+            watermarks[str(job["qq_number"])] = last_id
+            priors[str(job["qq_number"])] = (rel, imp)
+            sections.append(
+                f"用户{job['user']}(qq_number: {job['qq_number']})\n"
+                f"之前的印象：{self._format_prior_impression(rel, imp)}\n"
+                f"新的对话历史：\n{history}"
+            )
+
+        if not sections:
+            logger.info("合并总结的用户都没有新的聊天记录，跳过")
+            return []
+        jobs = [job for job in jobs if str(job["qq_number"]) in watermarks]
+
+        # 人设只发送一次，只带本批次用户的印象
+        dynamic_persona_prompt = await self.get_summary_persona_prompt(
+            json_persona_id, [job["qq_number"] for job in jobs]
+        )
+        users_text = "\n\n".join(sections)
+
+        prompt = f"""
+            请在之前印象的基础上，根据新的对话分别更新以下 {len(jobs)} 位用户与你(AI)的关系:\n
+            {users_text}\n
+            \n
+            要求：\n
+            1. 关系：判断是陌生人、朋友、死党、师生等。\n
+            2. 印象：简短描述（如：傲娇、博学、喜欢开玩笑）。\n
+            3. 每位用户输出一个对象，qq_number 必须与上面给出的一致。\n
+            4. 请严格按照 JSON 数组格式输出！！！，不要包含任何 Markdown 标记！！！。\n
+            格式示例：\n
+            [{{"qq_number": "123456", "relationship": "朋友", "impression": "非常幽默"}}]
+            """
+        self._record_prompt(prompt)
+        self.metrics.incr("summary.batch_calls")
+        self.metrics.observe("summary.batch_users", len(jobs))
+
+        try:
+            llm_resp = await self._call_summary_llm(
+                provider_id, dynamic_persona_prompt, prompt
+            )
+            llm_output = llm_resp.completion_text
+            logger.info(f"合并总结输出: {llm_output}")
+            parse_result = self.parse_llm_json(llm_output, is_summary_list)
+        except SummaryDeferred:
+            raise
+        except Exception as e:
+            self.metrics.incr("summary.llm_errors")
+            logger.error(f"合并总结调用大模型出错，改为逐个总结: {e}")
+            return list(jobs)
+
+        # 逐条校验：必须是本批次中的用户，且关系、印象都是非空字符串
+        pending = {str(job["qq_number"]): job for job in jobs}
+        results = {}
+        for item in parse_result if isinstance(parse_result, list) else []:
+            if not isinstance(item, dict):
+                continue
+            key = str(item.get("qq_number", ""))
+            rel = item.get("relationship")
+            imp = item.get("impression")
+            if key in pending and isinstance(rel, str) and rel and isinstance(imp, str) and imp:
+                results[key] = (rel, imp, watermarks[key], pending[key]["qq_number"])
+
+        if results:
+            if await self.set_sql_relationship_impression_many(list(results.values())):
+                for key, (rel, imp, _, qq_number) in results.items():
+                    self._cadence_feedback(qq_number, priors[key], (rel, imp))
+            else:
+                # 写库失败时水位没有推进，整批退回逐个总结
+                return list(jobs)
+
+        failed = [job for key, job in pending.items() if key not in results]
+        if failed:
+            self.metrics.incr("summary.batch_invalid", len(failed))
+            logger.warning(f"合并总结中有 {len(failed)} 个用户结果无效，将单独总结")
+        return failed
+
+    def _record_prompt(self, prompt):
+        """记录总结 Prompt 的大小；完整内容只在开启 debug_prompt_logging 时输出"""
+        self.metrics.observe("summary.prompt_tokens", estimate_tokens(prompt))
+        if self.config.get("debug_prompt_logging", False):
+            logger.info(prompt)
+
+    @timed("summary.duration")
+    async def llm_summary(self, umo, user, qq_number, json_persona_id):
         """调用LLM进行总结印象和关系"""
         logger.info(f"开始调用大模型进行总结，用户: {user}")
+        self.metrics.incr("summary.calls")
+
+        # 写回模式下先落库缓冲，保证能读到最新的聊天记录
+        if self._write_behind:
+            await self.flush_write_buffer()
 
         # 最大总结次数
         max_retries = self.config.get("summary_max_retries", 3)
 
-        # 总结时获取对应用户聊天记录条数
+        # 总结时最多读取的新聊天记录条数
         summary_history_count = self.config.get("summary_history_count", 20)
 
-        user_message_history = await self.get_recent_chat_history(
-            event.get_sender_id(), n=summary_history_count
+        # 只带该用户自己的旧印象，以及上次总结之后的新消息，Prompt 大小与用户数无关
+        pre_rel, pre_imp, after_id = await self.get_summary_state(qq_number)
+        (
+            user_message_history,
+            first_message_id,
+            last_message_id,
+        ) = await self.get_chat_history_since(qq_number, after_id, summary_history_count)
+        if not user_message_history:
+            logger.info(f"用户 {user} 自上次总结后没有新的聊天记录，跳过")
+            return None
+        pre_impression = self._format_prior_impression(pre_rel, pre_imp)
+
+        # 可选：从全文索引中检索与新对话相关的更早对话，作为补充上下文
+        related_history = await self.get_related_history(
+            qq_number,
+            user,
+            user_message_history,
+            first_message_id - 1,
+            int(self.config.get("summary_related_history_count", 0)),
         )
-        #logger.info(f"对话用户聊天记录:{user_Message_history}")
+        related_text = ""
+        if related_history:
+            related_text = f"与新对话相关的早期对话：\n{related_history}\n\n"
 
-        # 获取数据库中的关系和印象
-        pre_impression = await self.get_sql_relationship_impression()
-
-        # 获取当前的(动态)系统提示词
-        dynamic_persona_prompt = await self.get_dynamic_persona_prompt(json_persona_id)
+        # 人设只填入该用户自己的印象，不带其他用户
+        dynamic_persona_prompt = await self.get_summary_persona_prompt(
+            json_persona_id, [qq_number]
+        )
 
         prompt = f"""
-            请总结用户{user}与你(AI)的关系:\n
-            仅与该用户的对话历史：\n
+            请在之前印象的基础上，根据新的对话更新用户{user}与你(AI)的关系:\n
+            之前对该用户的印象：\n
+            {pre_impression}\n
+            \n
+            {related_text}上次总结之后与该用户的新对话：\n
             {user_message_history}\n
             \n
-            之前的印象：\n
-            {pre_impression}\n
             要求：\n
             1. 关系：判断是陌生人、朋友、死党、师生等。\n
             2. 印象：简短描述（如：傲娇、博学、喜欢开玩笑）。\n
@@ -420,124 +3159,123 @@ class PersonaFlow(Star):
             格式示例：\n
             {{"relationship": "朋友", "impression": "非常幽默"}}
             """
-        logger.info(prompt)
+        self._record_prompt(prompt)
 
         # 获取当前会话使用的聊天模型 ID
         for attempt in range(max_retries):
             try:
                 if attempt > 0:
-                    logger.info(f"正在进行第{attempt + 1}次重试...")
-                    await asyncio.sleep(1)
+                    self.metrics.incr("summary.retries")
+                    delay = self._backoff_delay(attempt)
+                    logger.info(f"{delay:.1f} 秒后进行第{attempt + 1}次重试...")
+                    await asyncio.sleep(delay)
 
-                umo = event.unified_msg_origin
                 provider_id = await self.context.get_current_chat_provider_id(umo=umo)
-                # logger.info(f"总结前的提示词: {prompt}")
-                # 调用大模型
-                llm_resp = await self.context.llm_generate(
-                    chat_provider_id=provider_id,
-                    system_prompt=dynamic_persona_prompt,  # 让机器人用当前人设去思考印象
-                    prompt=prompt,
+                # 调用大模型(让机器人用当前人设去思考印象)
+                # JSON 对象模式只能约束顶层为对象，合并总结的数组输出不使用
+                llm_resp = await self._call_summary_llm(
+                    provider_id, dynamic_persona_prompt, prompt, json_mode=True
                 )
                 llm_output = llm_resp.completion_text
                 logger.info(f"总结输出: {llm_output}")
 
-                parse_result = self.parse_llm_json(llm_output)
-                if parse_result and "relationship" in parse_result:
+                parse_result = self.parse_llm_json(llm_output, is_summary_object)
+                if parse_result is not None:
                     rel = parse_result["relationship"]
                     imp = parse_result["impression"]
 
-                    # 存入数据库
-                    await self.set_sql_relationship_impression(qq_number, rel, imp)
+                    # 存入数据库；写库失败不算成功，也不调整总结节奏
+                    if not await self.set_sql_relationship_impression(
+                        qq_number, rel, imp, last_message_id
+                    ):
+                        self.metrics.incr("summary.failed")
+                        return None
+                    self.metrics.incr("summary.success")
+                    self._cadence_feedback(qq_number, (pre_rel, pre_imp), (rel, imp))
 
                     # 返回格式化后的字符串，用于插入到 Persona Prompt 中
                     return f"{user}({rel}){qq_number}印象:{imp}。"
                 else:
+                    self.metrics.incr("summary.parse_failures")
                     logger.warning(
                         f"总结JSON解析失败，重试 {attempt + 1}/{max_retries}"
                     )
+            except SummaryDeferred:
+                raise
             except Exception as e:
+                self.metrics.incr("summary.llm_errors")
                 logger.error(f"第 {attempt + 1} 次调用大模型出错: {e}")
 
+        self.metrics.incr("summary.failed")
         logger.error(f"连续 {max_retries} 次总结均失败，跳过本次更新。")
         return None
 
-    def merge_AI_and_user_message(self, user_messages, ai_messages, user_name):
-        """合并用户和AI的消息记录"""
-        ai_personas = self.config.get("personas_name", "AI助手")
-        merged_messages = f"""
-        {user_name}: \"{user_messages}\" {ai_personas}: \"{ai_messages}\"\n
-        """
-        return merged_messages.strip()
-
     # 解析LLM返回的JSON
-    def parse_llm_json(self, text):
-        """解析 JSON 工具函数"""
-        try:
-            # 尝试直接解析
-            return json.loads(text)
-        except Exception:
-            pass
-
-        try:
-            match = re.search(r"(\{.*\}|\[.*\])", text, re.DOTALL)
-            if match:
-                return json.loads(match.group(0))
-        except Exception:
-            pass
+    def parse_llm_json(self, text, accept=None):
+        """解析 JSON 工具函数；accept 为结构校验函数，不符合的候选会被跳过"""
+        value, repaired = parse_json_payload(text, accept)
+        if value is None:
+            self.metrics.incr("parse.failed")
+        else:
+            self.metrics.incr("parse.repaired" if repaired else "parse.ok")
+        return value
 
-        try:
-            match = re.search(r"(\{.*\}|\[.*\])", text, re.DOTALL)
-            if match:
-                return ast.literal_eval(match.group(0))
-        except Exception:
-            pass
+    # ************* astrbot人格提示词操作函数 **********
 
+    def _get_template(self, base_persona_id):
+        """按名称查找预切分的人格模板；人格列表变化时才重建索引"""
+        personas = self.context.provider_manager.personas
+        target = str(base_persona_id)
+
+        if self._template_source != (id(personas), len(personas)):
+            self._rebuild_template_index(personas)
+        entry = self._template_index.get(target)
+        if entry is not None:
+            index, source, template = entry
+            # 同一位置的人格被替换或 prompt 被修改时重建
+            if (
+                index < len(personas)
+                and personas[index] is source
+                and source.get("prompt") is template.prompt
+            ):
+                return template
+            self._rebuild_template_index(personas)
+            entry = self._template_index.get(target)
+            if entry is not None:
+                return entry[2]
+
+        logger.warning(f"内存中未找到名称或 ID 为 '{base_persona_id}' 的人格。")
         return None
 
-    # ************* astrbot人格提示词操作函数 **********
+    def _rebuild_template_index(self, personas):
+        """重建 名称 -> (列表位置, 原始人格, PersonaTemplate) 索引，同名时取第一个"""
+        index = {}
+        for i, p in enumerate(personas):
+            p_name = str(p.get("name")) if p.get("name") is not None else "None"
+            if p_name in index:
+                continue
+            p_config = p.get("persona_config", {})
+            # 获取其他属性
+            begin_dialogs = p_config.get("begin_dialogs") or p.get("begin_dialogs", [])
+            tools = p_config.get("tools") or p.get("tools", [])
+            index[p_name] = (i, p, PersonaTemplate(p.get("prompt"), begin_dialogs, tools))
+        self._template_index = index
+        self._template_source = (id(personas), len(personas))
+        logger.info(f"已索引 {len(index)} 个人格模板")
 
     def get_persona_template(self, base_persona_id):
         """从 AstrBot 内存中直接获取人格模板"""
         try:
-            # 1. 获取 personas 列表
-            all_personas = self.context.provider_manager.personas
-
-            target_persona = None
-
-            for p in all_personas:
-                # 获取当前遍历对象的 ID 和 Name
-                # p_id = str(p.get("id")) if p.get("id") is not None else "None"
-                p_name = str(p.get("name")) if p.get("name") is not None else "None"
-                target = str(base_persona_id)
-
-                # if p_id == target or p_name == target:
-                if p_name == target:
-                    target_persona = p
-                    break
-
-            if target_persona:
-                logger.info(f"从内存中成功获取人格: {base_persona_id}")
-
-                p_config = target_persona.get("persona_config", {})
-
-                sys_prompt = target_persona.get("prompt")
-
-                # 获取其他属性
-                begin_dialogs = p_config.get("begin_dialogs") or target_persona.get(
-                    "begin_dialogs", []
-                )
-                tools = p_config.get("tools") or target_persona.get("tools", [])
-
-                return sys_prompt, begin_dialogs, tools
-
-            else:
-                logger.warning(f"内存中未找到名称或 ID 为 '{base_persona_id}' 的人格。")
+            template = self._get_template(base_persona_id)
+            if template is None:
                 return None, None, None
+            return template.prompt, template.begin_dialogs, template.tools
 
         except Exception as e:
             logger.error(f"获取内存人格数据失败: {e}", exc_info=True)
             return None, None, None
 
+    @timed("db.update_dynamic_persona")
     async def update_dynamic_persona(self, base_persona_id, new_system_prompt):
         """更新或创建astrbot'动态'人格"""
         db = await self._get_db()
@@ -592,31 +3330,34 @@ class PersonaFlow(Star):
                     )
 
                 await db.commit()
+                # 写穿缓存，同时作废写入前发起、尚未返回的读取
+                self._persona_version += 1
+                self._persona_cache[target_dynamic_id] = (
+                    new_system_prompt,
+                    self._persona_version,
+                )
                 logger.info(f"成功更新 ID 为 {target_dynamic_id} 的人格提示词。")
 
             except Exception as e:
                 logger.error(f"设置动态人格提示词失败: {e}")
                 await db.rollback()
+                self._persona_version += 1
+                self._persona_cache.pop(target_dynamic_id, None)
 
     async def write_astrbot_persona_prompt(self, base_persona_id, summary_text):
         """逻辑整合函数"""
         try:
-            # 1. 获取带有 {Impression} 的原始模板
-            raw_prompt, _, _ = self.get_persona_template(base_persona_id)
+            # 1. 获取预先按 {Impression} 切分的模板
+            template = self._get_template(base_persona_id)
 
-            if not raw_prompt:
+            if template is None or not template.prompt:
                 logger.error("无法获取模板，停止更新。")
                 return
 
-            # 2. 执行替换逻辑
-            if "{Impression}" in raw_prompt:
-                formatted_prompt = raw_prompt.replace("{Impression}", str(summary_text))
-                # logger.info(f"占位符替换成功,替换后:{formatted_prompt}")
-
-            else:
-                # 兜底：如果没有占位符，追加到末尾
+            # 2. 拼接印象文本
+            if not template.slots:
                 logger.warning("模板中未找到 {Impression} 占位符，将追加到末尾。")
-                formatted_prompt = raw_prompt + f"\n\n关于用户的印象：{summary_text}"
+            formatted_prompt = self._render_template(template, summary_text)
 
             # 3. 保存到动态 ID 数据库中
             await self.update_dynamic_persona(base_persona_id, formatted_prompt)
@@ -624,24 +3365,143 @@ class PersonaFlow(Star):
         except Exception as e:
             logger.error(f"替换人格提示词流程失败: {e}")
 
-    async def get_dynamic_persona_prompt(self, persona_id):
-        """获取Prompt"""
-        dynamic_id = persona_id + "动态"
-
-        local_prompt = await self.get_dynamic_persona(dynamic_id)
+    def _render_template(self, template, summary_text):
+        if self._cache_layout:
+            return template.render_appended(summary_text)
+        return template.render(summary_text)
+
+    # 最多记录上一次 Prompt 的人格/会话数
+    MAX_TRACKED_PROMPTS = 256
+    # 前缀比较的粒度(字符)；服务商的前缀缓存本身也按块命中
+    PREFIX_BLOCK = 256
+    _DIGEST_SIZE = 8
+
+    @classmethod
+    def _prefix_digests(cls, prompt):
+        """每 PREFIX_BLOCK 个字符一个累积摘要：第 i 个摘要相同，说明前 i + 1 块完全相同"""
+        h = hashlib.blake2b(digest_size=cls._DIGEST_SIZE)
+        digests = []
+        for start in range(0, len(prompt), cls.PREFIX_BLOCK):
+            h.update(prompt[start : start + cls.PREFIX_BLOCK].encode("utf-8"))
+            digests.append(h.copy().digest())
+        return b"".join(digests)
+
+    def _record_prompt_prefix(self, key, prompt):
+        """统计相邻两次请求的 System Prompt 共同前缀长度(决定服务商的前缀缓存能命中多少)
+
+        只保存上一次的分块摘要和长度，不保存 Prompt 原文
+        """
+        digests = self._prefix_digests(prompt)
+        previous = self._last_prompts.get(key)
+        self._last_prompts[key] = (digests, len(prompt))
+        self._last_prompts.move_to_end(key)
+        if len(self._last_prompts) > self.MAX_TRACKED_PROMPTS:
+            self._last_prompts.popitem(last=False)
+        if previous is None:
+            return
 
-        if local_prompt:
-            return local_prompt
+        self.metrics.incr("prompt.compared")
+        prev_digests, prev_length = previous
+        if prev_digests == digests and prev_length == len(prompt):
+            self.metrics.incr("prompt.identical")
+            common = len(prompt)
         else:
-            # 如果本地没有，去主数据库读取原始模板作为兜底
-            logger.warning(f"动态人格 {dynamic_id} 尚未生成，降级读取原始人格。")
-            prompt, _, _ = self.get_persona_template(persona_id)
-            return prompt if prompt else ""
+            size = self._DIGEST_SIZE
+            blocks = 0
+            for i in range(0, min(len(digests), len(prev_digests)), size):
+                if digests[i : i + size] != prev_digests[i : i + size]:
+                    break
+                blocks += 1
+            common = min(blocks * self.PREFIX_BLOCK, len(prompt), prev_length)
+        self.metrics.observe("prompt.common_prefix_chars", common)
+        self.metrics.observe(
+            "prompt.prefix_kept_pct",
+            100 * common // max(1, len(prompt)),
+            PluginMetrics.PERCENT_BOUNDS,
+        )
+
+    async def get_summary_persona_prompt(self, persona_id, qq_numbers):
+        """总结用的人设：原始模板中只填入被总结用户的印象，大小与用户总数无关"""
+        template = self._get_template(persona_id)
+        if template is None or not template.prompt:
+            return ""
+        return template.render(await self.get_session_impression(qq_numbers))
+
+    async def initialize(self):
+        """插件实例化后由 AstrBot 调用：开启内存用户表时在启动阶段预热，不必等到第一条消息"""
+        if self._registry_enabled:
+            try:
+                await self._get_user_registry()
+            except Exception as e:
+                logger.error(f"预热内存用户表失败，将在首次使用时重试: {e}")
+        for child in self._shard_children:
+            await child.initialize()
 
     async def terminate(self):
         """插件卸载时关闭连接"""
+        for child in self._shard_children:
+            try:
+                await child.terminate()
+            except Exception as e:
+                logger.error(f"关闭分片 {child.shard_name} 失败: {e}")
+
+        # 取消后台任务并等它们退出：被打断的批次先回滚、维护撤掉时间限制，之后才能关闭连接
+        for attr in (
+            "_external_task",
+            "_retention_task",
+            "_registry_task",
+            "_metrics_task",
+            "_fts_task",
+            "_compact_task",
+            "_maintenance_task",
+            "_cadence_task",
+        ):
+            task = getattr(self, attr)
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                setattr(self, attr, None)
+
+        # 停止总结 worker，未执行的任务会在用户下次达到阈值时重新触发
+        for handle in self._summary_deferred.values():
+            handle.cancel()
+        self._summary_deferred.clear()
+        for worker in self._summary_workers:
+            worker.cancel()
+        if self._summary_workers:
+            await asyncio.gather(*self._summary_workers, return_exceptions=True)
+        self._summary_workers = []
+
+        # 停止写回任务并把剩余缓冲全部落库
+        if self._write_task:
+            self._write_task.cancel()
+            try:
+                await self._write_task
+            except asyncio.CancelledError:
+                pass
+            self._write_task = None
+        # 即使队列已空也要经过 flush 锁：被取消的任务里 shield 住的提交可能仍在写库
+        try:
+            await self.flush_write_buffer()
+        except Exception as e:
+            logger.error(f"卸载时提交写回缓冲失败: {e}")
+        try:
+            await self.flush_user_registry()
+        except Exception as e:
+            logger.error(f"卸载时内存用户表落库失败: {e}")
+
+        await self.dump_metrics()
+        await self._close_read_pool()
         if self.db:
             try:
+                # SQLite 建议在关闭长连接前执行一次，只会分析需要更新统计信息的表；
+                # 此时其他连接都已关闭，同样限制耗时，避免拖慢卸载
+                budget_ms = max(10, int(self.config.get("maintenance_time_budget_ms", 200)))
+                try:
+                    async with self._time_limit(self.db, budget_ms):
+                        await self.db.execute("PRAGMA optimize")
+                except Exception as e:
+                    logger.warning(f"关闭前 PRAGMA optimize 未完成: {e}")
                 await self.db.close()
                 logger.info("PersonaFlow 数据库连接已关闭。")
             except Exception as e:
@@ -654,30 +3514,137 @@ class PersonaFlow(Star):
     def osn(self):
         pass
 
+    # /osn check 的排序方式: 名称 -> (排序表达式, 是否降序)，同值时按 qq_number 升序
+    CHECK_SORTS = {
+        "qq": ("qq_number", False),
+        "count": ("COALESCE(dialogue_count, 0)", True),
+        "active": ("COALESCE(last_active_at, '')", True),
+    }
+    CHECK_SORT_ALIASES = {"次数": "count", "活跃": "active"}
+    CHECK_SORT_LABELS = {"qq": "QQ号", "count": "对话次数", "active": "最近活跃"}
+    MAX_CHECK_CURSORS = 64  # 缓存翻页游标的查询数
+
+    @classmethod
+    def _parse_check_args(cls, *tokens):
+        """解析 /osn check 参数：第一个纯数字为页码，排序名为排序方式，其余拼成关键词"""
+        page, sort, words = 1, "qq", []
+        for index, token in enumerate(t.strip() for t in tokens if t and t.strip()):
+            key = cls.CHECK_SORT_ALIASES.get(token, token.lower())
+            if index == 0 and token.isdigit():
+                page = max(1, int(token))
+            elif key in cls.CHECK_SORTS:
+                sort = key
+            else:
+                words.append(token)
+        return page, " ".join(words), sort
+
+    @timed("db.select_impression_page")
+    async def select_impression_page(self, keyword, sort, after, limit, keys_only=False):
+        """键集分页读取印象，after 为上一页最后一行的 (排序值, qq_number)；keys_only 时只取键列"""
+        column, desc = self.CHECK_SORTS[sort]
+        conditions, params = [], []
+        if keyword:
+            pattern = "%" + re.sub(r"([\\%_])", r"\\\1", keyword) + "%"
+            conditions.append(
+                "(name LIKE ? ESCAPE '\\' OR relationship LIKE ? ESCAPE '\\' "
+                "OR impression LIKE ? ESCAPE '\\')"
+            )
+            params += [pattern] * 3
+        if after is not None:
+            if sort == "qq":
+                conditions.append("qq_number > ?")
+                params.append(after[1])
+            else:
+                op = "<" if desc else ">"
+                conditions.append(f"({column} {op} ? OR ({column} = ? AND qq_number > ?))")
+                params += [after[0], after[0], after[1]]
+
+        columns = f"{column}, qq_number"
+        if not keys_only:
+            columns += ", name, relationship, impression, dialogue_count"
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        order = "DESC" if desc else "ASC"
+        sql = f"SELECT {columns} FROM Impression{where} ORDER BY {column} {order}, qq_number LIMIT ?"
+        params.append(limit)
+
+        async with self._read_conn() as db:
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def _locate_check_page(self, keyword, sort, page, page_size):
+        """返回第 page 页的起始游标；未缓存时从最近的已知游标起只扫描键列，超出范围返回 False"""
+        key = (keyword, sort, page_size)
+        cursors = self._check_cursors.get(key)
+        if cursors is None or page == 1:
+            # 从第一页重新查看时丢弃旧游标，避免沿用过期的分页边界
+            cursors = self._check_cursors[key] = [None]
+            if len(self._check_cursors) > self.MAX_CHECK_CURSORS:
+                self._check_cursors.popitem(last=False)
+        else:
+            self._check_cursors.move_to_end(key)
+
+        while len(cursors) < page:
+            rows = await self.select_impression_page(
+                keyword, sort, cursors[-1], page_size, keys_only=True
+            )
+            if len(rows) < page_size:
+                return False
+            cursors.append(tuple(rows[-1][:2]))
+        return cursors[page - 1]
+
     @osn.command("check")
-    async def check_memory(self, event: AstrMessageEvent):
+    async def check_memory(
+        self, event: AstrMessageEvent, page: str = "", keyword: str = "", sort: str = ""
+    ):
         """
-        查看数据库中所有已保存的人物印象
+        分页查看数据库中已保存的人物印象
+        用法: /osn check [页码] [关键词] [排序: qq/count/active]
         """
-        db = await self._get_db()
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.check_memory(event, page, keyword, sort):
+                yield result
+            return
+
+        page_no, keyword, sort = self._parse_check_args(page, keyword, sort)
+        page_size = min(max(1, int(self.config.get("check_page_size", 10))), 50)
+
+        # 先落库内存中的计数，保证显示的对话次数是最新的
+        await self.flush_user_registry()
         try:
-            sql = "SELECT qq_number, name, relationship, impression, dialogue_count FROM Impression"
-            async with db.execute(sql) as cursor:
-                rows = await cursor.fetchall()
+            after = await self._locate_check_page(keyword, sort, page_no, page_size)
+            rows = []
+            if after is not False:
+                # 多取一行，用来判断是否还有下一页
+                rows = await self.select_impression_page(keyword, sort, after, page_size + 1)
 
             if not rows:
-                yield event.plain_result("📂 数据库中暂无任何印象记录。")
+                if page_no > 1:
+                    yield event.plain_result(f"📂 第 {page_no} 页没有记录，请减小页码。")
+                elif keyword:
+                    yield event.plain_result(f"📂 没有找到包含“{keyword}”的印象记录。")
+                else:
+                    yield event.plain_result("📂 数据库中暂无任何印象记录。")
                 return
 
-            msg_list = ["📂 当前已存储的人物印象：", "=" * 20]
-            
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+            cursors = self._check_cursors.get((keyword, sort, page_size))
+            if has_next and cursors is not None and len(cursors) == page_no:
+                cursors.append(tuple(rows[-1][:2]))
+
+            title = f"📂 人物印象 第 {page_no} 页（按{self.CHECK_SORT_LABELS[sort]}排序"
+            if keyword:
+                title += f"，关键词：{keyword}"
+            msg_list = [title + "）", "=" * 20]
+
             for row in rows:
-                uid = row[0]
-                name = row[1] if row[1] else "未知"
-                rel = row[2] if row[2] else "暂无"
-                imp = row[3] if row[3] else "暂无"
-                count = row[4]
-                
+                uid = row[1]
+                name = row[2] if row[2] else "未知"
+                rel = row[3] if row[3] else "暂无"
+                imp = row[4] if row[4] else "暂无"
+                count = row[5]
+
                 info = (
                     f"👤 用户: {name} ({uid})\n"
                     f"🔗 关系: {rel}\n"
@@ -686,15 +3653,251 @@ class PersonaFlow(Star):
                 )
                 msg_list.append(info)
                 msg_list.append("-" * 20)
-            
-            # 避免消息过长，简单合并
-            result_text = "\n".join(msg_list)
-            yield event.plain_result(result_text)
+
+            if has_next:
+                args = " ".join(x for x in (str(page_no + 1), keyword, sort) if x)
+                msg_list.append(f"➡️ 下一页：/osn check {args}")
+
+            yield event.plain_result("\n".join(msg_list))
 
         except Exception as e:
             logger.error(f"查询数据库失败: {e}")
             yield event.plain_result(f"❌ 查询失败: {e}")
 
+    @osn.command("queue")
+    async def summary_queue(self, event: AstrMessageEvent):
+        """
+        查看后台总结队列状态
+        """
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.summary_queue(event):
+                yield result
+            return
+
+        status = self.summary_queue_status()
+        pending = "、".join(str(q) for q in status["pending_users"]) or "无"
+        rest = status["pending"] - len(status["pending_users"])
+        if rest > 0:
+            pending += f" 等，另有 {rest} 个"
+        yield event.plain_result(
+            f"📋 总结队列：排队 {status['queued']} 个，执行中 {status['in_flight']} 个，"
+            f"熔断推迟 {status['deferred']} 个\n"
+            f"⏳ 等待总结的用户：{pending}"
+        )
+
+    @osn.command("stats")
+    async def show_stats(self, event: AstrMessageEvent):
+        """
+        查看插件运行指标：计数器与耗时分布
+        """
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.show_stats(event):
+                yield result
+            return
+
+        snapshot = self.metrics.snapshot()
+        lines = [f"📊 PersonaFlow 运行指标（已运行 {snapshot['uptime_s']:.0f} 秒）"]
+        if self._shard_children or self.is_shard:
+            lines.append(f"分片：{self.shard_name}（{self.db_path}）")
+
+        if snapshot["counters"]:
+            lines.append("=" * 20)
+            for name, value in snapshot["counters"].items():
+                lines.append(f"{name}: {value}")
+
+        if snapshot["histograms"]:
+            lines.append("=" * 20)
+            lines.append("名称: 次数 | 平均 | p50 | p99 | 最大 (耗时单位 ms)")
+            for name, h in snapshot["histograms"].items():
+                lines.append(
+                    f"{name}: {h['count']} | {h['mean']:g} | {h['p50']:g} | "
+                    f"{h['p99']:g} | {h['max']:g}"
+                )
+
+        status = self.summary_queue_status()
+        lines.append("=" * 20)
+        lines.append(f"总结队列：排队 {status['queued']}，执行中 {status['in_flight']}")
+        kept = snapshot["histograms"].get("prompt.prefix_kept_pct")
+        if kept:
+            identical = snapshot["counters"].get("prompt.identical", 0)
+            lines.append(
+                f"Prompt 共同前缀：平均保留 {kept['mean']:g}%（p50 {kept['p50']:g}%），"
+                f"完全相同 {identical}/{kept['count']}"
+            )
+        if self._cadence is not None:
+            cap = self._cadence.hourly_cap
+            lines.append(
+                f"自适应总结：近一小时触发 {self._cadence.fired_last_hour()}"
+                f"{f' / {cap}' if cap > 0 else ''} 次"
+            )
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @osn.command("search")
+    async def search_memory(self, event: AstrMessageEvent, keyword: str = "", user: str = ""):
+        """
+        全文搜索聊天记录
+        用法: /osn search <关键词> [用户ID]
+        """
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.search_memory(event, keyword, user):
+                yield result
+            return
+
+        if not keyword:
+            yield event.plain_result("❌ 请输入关键词。例如: /osn search 火锅 123456")
+            return
+        await self._get_db()
+        if not self._fts_tokenizer:
+            yield event.plain_result("⚠️ 当前 SQLite 不支持 FTS5 全文索引，无法搜索。")
+            return
+        if self._write_behind:
+            await self.flush_write_buffer()
+
+        limit = min(max(1, int(self.config.get("search_result_limit", 10))), 50)
+        try:
+            rows = await self.search_messages(keyword, user or None, limit)
+        except Exception as e:
+            logger.error(f"搜索聊天记录失败: {e}")
+            yield event.plain_result(f"❌ 搜索失败: {e}")
+            return
+
+        if not rows:
+            yield event.plain_result(f"🔍 没有找到包含“{keyword}”的聊天记录。")
+            return
+
+        msg_list = [f"🔍 “{keyword}”的搜索结果（按相关度）：", "=" * 20]
+        for _, qq_number, chat_time, snippet in rows:
+            msg_list.append(f"👤 {qq_number}  🕒 {chat_time}\n{snippet}")
+            msg_list.append("-" * 20)
+        if self._fts_backfill_upto > 0:
+            msg_list.append("⏳ 较早的聊天记录仍在建立索引，结果可能不完整。")
+        yield event.plain_result("\n".join(msg_list))
+
+    def _export_file_path(self, filename):
+        """导出文件只允许放在插件数据目录的 exports 下，指令中只接受文件名"""
+        name = os.path.basename(filename.strip())
+        if not name or name in (".", ".."):
+            return None
+        return os.path.join(self.export_dir, name)
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @osn.command("export")
+    async def export_memory(self, event: AstrMessageEvent, filename: str = ""):
+        """
+        导出印象、聊天记录和动态人格到 JSONL.gz
+        用法: /osn export [文件名]
+        """
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.export_memory(event, filename):
+                yield result
+            return
+
+        if not filename:
+            filename = f"personaflow-{self.shard_name}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz"
+        path = self._export_file_path(filename)
+        if path is None:
+            yield event.plain_result("❌ 文件名无效。")
+            return
+
+        # 先落库内存中的缓冲，导出的是完整数据
+        if self._write_behind:
+            await self.flush_write_buffer()
+        await self.flush_user_registry()
+        await self._get_db()
+
+        try:
+            os.makedirs(self.export_dir, exist_ok=True)
+            # 独立连接在线程中流式导出，不占用插件的读写连接
+            with self.metrics.timer("io.export"):
+                counts = await asyncio.to_thread(export_memories, self.db_path, path)
+        except Exception as e:
+            logger.error(f"导出记忆失败: {e}")
+            yield event.plain_result(f"❌ 导出失败: {e}")
+            return
+
+        logger.info(f"已导出记忆到 {path}: {counts}")
+        yield event.plain_result(
+            f"📦 已导出到 {path}\n"
+            f"印象 {counts['Impression']} 条，聊天记录 {counts['Message']} 条，"
+            f"动态人格 {counts['dynamic_personas']} 条"
+        )
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @osn.command("import")
+    async def import_memory(self, event: AstrMessageEvent, filename: str = "", mode: str = "skip"):
+        """
+        从 exports 目录导入记忆
+        用法: /osn import <文件名> [skip/overwrite/merge]
+        """
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.import_memory(event, filename, mode):
+                yield result
+            return
+
+        path = self._export_file_path(filename) if filename else None
+        if path is None or not os.path.isfile(path):
+            yield event.plain_result(
+                f"❌ 请指定 {self.export_dir} 下的导出文件。例如: /osn import backup.jsonl.gz merge"
+            )
+            return
+        if mode not in IMPORT_MODES:
+            yield event.plain_result(f"❌ 冲突处理方式只能是 {'/'.join(IMPORT_MODES)}")
+            return
+
+        # 导入前把缓冲落库，导入后内存中的印象、计数和人格缓存全部失效
+        if self._write_behind:
+            await self.flush_write_buffer()
+        await self.flush_user_registry()
+        await self._get_db()
+
+        yield event.plain_result(f"⏳ 正在导入 {os.path.basename(path)}（{mode}）...")
+        try:
+            # 分块小事务，块之间让出写锁，导入期间聊天照常记录
+            with self.metrics.timer("io.import"):
+                counts = await asyncio.to_thread(
+                    import_memories, self.db_path, path, mode, 1000, 0.01
+                )
+        except Exception as e:
+            logger.error(f"导入记忆失败: {e}")
+            yield event.plain_result(f"❌ 导入失败: {e}")
+            return
+        finally:
+            await self._reset_memory_caches()
+
+        logger.info(f"已从 {path} 导入记忆({mode}): {counts}")
+        if self._compact_storage:
+            # 导入的是整段文本格式，可能带着较小的 id，从头检查一遍
+            async with self._db_lock:
+                self._compact_upto = 0
+            if self._compact_task is None:
+                self._compact_task = asyncio.create_task(self._compact_migration_loop())
+        json_persona_id = self.config.get("personas_name", "")
+        if json_persona_id:
+            async with self._persona_write_lock:
+                new_full_impression = await self.get_sql_relationship_impression()
+                await self.write_astrbot_persona_prompt(json_persona_id, new_full_impression)
+
+        yield event.plain_result(
+            f"✅ 导入完成：印象 {counts['Impression']} 条，聊天记录 {counts['Message']} 条，"
+            f"动态人格 {counts['dynamic_personas']} 条"
+        )
+
+    async def _reset_memory_caches(self):
+        """数据库被批量修改后丢弃内存中的派生数据，下次使用时重新加载"""
+        # 导入期间内存用户表里新增的计数先落库，不能随缓存一起丢掉
+        await self.flush_user_registry()
+        self._impression_block = None
+        self._user_registry = None
+        self._persona_version += 1
+        self._persona_cache.clear()
+        self._check_cursors.clear()
+
     @osn.command("del")
     async def delete_memory(self, event: AstrMessageEvent, target_id: str):
         """
@@ -705,16 +3908,26 @@ class PersonaFlow(Star):
             yield event.plain_result("❌ 请输入要删除的用户ID。例如: /osn del 123456")
             return
 
+        shard = self._route(event)
+        if shard is not self:
+            async for result in shard.delete_memory(event, target_id):
+                yield result
+            return
+
         # 获取配置文件中的基础人格ID (用于后续更新 Prompt)
         json_persona_id = self.config.get("personas_name", "")
         if not json_persona_id:
             yield event.plain_result("⚠️ 警告：配置文件中未设置 personas_name，仅删除数据，无法刷新动态人格。")
 
+        # 先落库写回缓冲，避免删除后又被缓冲中的数据写回
+        if self._write_behind:
+            await self.flush_write_buffer()
+
         db = await self._get_db()
         user_name = "未知用户"
         
         # 执行数据库删除操作 (在一个事务锁中完成)
-        async with self._db_lock:
+        async with self._user_lock(target_id), self._db_lock:
             try:
                 # 检查用户是否存在
                 async with db.execute("SELECT name FROM Impression WHERE qq_number = ?", (target_id,)) as cursor:
@@ -729,11 +3942,32 @@ class PersonaFlow(Star):
                 # 删除印象表记录
                 await db.execute("DELETE FROM Impression WHERE qq_number = ?", (target_id,))
                 
-                # 删除聊天记录表记录
+                # 删除聊天记录表记录(含归档)
+                if self._fts_tokenizer:
+                    async with db.execute(
+                        f"SELECT id, {self.MESSAGE_COLUMNS} FROM Message "
+                        "WHERE qq_number = ? AND message IS NULL",
+                        (target_id,),
+                    ) as cursor:
+                        compact = await cursor.fetchall()
+                    texts = await self._decode_messages([row[1:] for row in compact])
+                    await self._fts_delete_compact(
+                        db, [(row[0], text) for row, text in zip(compact, texts)]
+                    )
                 await db.execute("DELETE FROM Message WHERE qq_number = ?", (target_id,))
+                await db.execute("DELETE FROM MessageArchive WHERE qq_number = ?", (target_id,))
                 
                 await db.commit()
+                if self._impression_block is not None:
+                    self._impression_block.remove(target_id)
+                if self._user_registry is not None:
+                    self._user_registry.remove(target_id)
                 logger.info(f"已从数据库删除用户 {user_name}({target_id}) 的所有数据")
+
+                # 旧 Prompt 中仍包含该用户，先作废缓存，刷新成功后会重新写入
+                if json_persona_id:
+                    self._persona_version += 1
+                    self._persona_cache.pop(json_persona_id + "动态", None)
                 
             except Exception as e:
                 await db.rollback()
@@ -0,0 +1,328 @@
+"""
+PersonaFlow 记忆导出/导入
+
+以 JSONL(可 gzip 压缩) 流式导出/导入 Impression、Message 和 dynamic_personas 三张表，
+按块读写，不会把整表读进内存。只依赖标准库，可以脱离 AstrBot 单独运行:
+
+    python -m astrbot_plugin_PersonaFlow.memory_io export OSNpermemory.db backup.jsonl.gz
+    python -m astrbot_plugin_PersonaFlow.memory_io import OSNpermemory.db backup.jsonl.gz --mode merge
+
+导入的目标数据库需要已由插件创建(表结构由插件负责建立和升级)。
+紧凑存储格式的聊天记录导出时还原为整段文本，导出文件与数据库使用哪种存储格式无关。
+
+聊天记录的 id 在不同数据库之间没有意义，任何模式下都由目标库重新分配；
+qq_number、chat_time 和整段文本都相同的记录视为已存在，不会重复导入。
+
+冲突处理(--mode):
+    skip      已存在的用户/人格保持不变
+    overwrite 用导入的数据覆盖已存在的记录
+    merge     对话次数相加，已有的关系与印象保留；动态人格取 updated_at 较新的一方
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sqlite3
+import time
+
+from .message_codec import decode_message
+
+FORMAT_NAME = "personaflow-export"
+FORMAT_VERSION = 1
+MODES = ("skip", "overwrite", "merge")
+
+# 导出的表及其冲突键；聊天记录按 MESSAGE_KEY 判重
+TABLES = {
+    "Impression": "qq_number",
+    "Message": "id",
+    "dynamic_personas": "persona_id",
+}
+
+# 紧凑存储格式的列，导出时合并回 message
+COMPACT_COLUMNS = ("user_text", "ai_text", "speaker_id", "ai_speaker_id")
+
+# 判断聊天记录是否已存在的列
+MESSAGE_KEY = ("qq_number", "chat_time", "message")
+
+
+def _open_text(path, mode):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _encode(value):
+    # BLOB 列用 base64 包一层，保证每行都是合法 JSON
+    if isinstance(value, bytes | bytearray | memoryview):
+        return {"$b64": base64.b64encode(bytes(value)).decode("ascii")}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and "$b64" in value:
+        return base64.b64decode(value["$b64"])
+    return value
+
+
+def _speakers(conn):
+    try:
+        return dict(conn.execute("SELECT id, name FROM Speaker"))
+    except sqlite3.OperationalError:  # 旧版本数据库没有 Speaker 表
+        return {}
+
+
+def _legacy_message(record, speakers):
+    """把紧凑格式的聊天记录还原为整段文本，并去掉紧凑存储的列"""
+    compact = {c: record.pop(c, None) for c in COMPACT_COLUMNS}
+    if record.get("message") is None and compact["speaker_id"] is not None:
+        record["message"] = decode_message(
+            None,
+            compact["user_text"],
+            compact["ai_text"],
+            speakers.get(compact["speaker_id"], ""),
+            speakers.get(compact["ai_speaker_id"], ""),
+        )
+    return record
+
+
+def connect(db_path, busy_timeout_ms=5000):
+    """打开一个独立连接；与插件的连接并存，遇到写锁时等待而不是报错"""
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+    return conn
+
+
+def export_memories(db_path, out_path, chunk_size=1000):
+    """导出到 JSONL，返回各表行数；整个导出读取同一个快照"""
+    counts = {}
+    conn = connect(db_path)
+    try:
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.execute("BEGIN")
+        speakers = _speakers(conn)
+        with _open_text(out_path, "w") as f:
+            header = {
+                "format": FORMAT_NAME,
+                "version": FORMAT_VERSION,
+                "schema_version": schema_version,
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+
+            for table in TABLES:
+                cursor = conn.execute(f"SELECT * FROM {table} ORDER BY rowid")
+                columns = [d[0] for d in cursor.description]
+                counts[table] = 0
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        record = dict(zip(columns, row))
+                        if table == "Message":
+                            record = _legacy_message(record, speakers)
+                        record = {c: _encode(v) for c, v in record.items()}
+                        f.write(
+                            json.dumps({"table": table, "row": record}, ensure_ascii=False)
+                            + "\n"
+                        )
+                    counts[table] += len(rows)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return counts
+
+
+def _table_columns(conn, table):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if not columns:
+        raise ValueError(f"目标数据库缺少 {table} 表，请先启动一次插件完成建表")
+    return columns
+
+
+def _insert_sql(table, columns, mode):
+    """按冲突处理方式生成 INSERT 语句"""
+    key = TABLES[table]
+    marks = ", ".join("?" for _ in columns)
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({marks})"
+    if table == "Message":
+        # 聊天记录不带 id 插入，重复的记录已由 _new_messages 去掉
+        return sql
+    if mode == "skip":
+        return sql + f" ON CONFLICT({key}) DO NOTHING"
+
+    updates = [c for c in columns if c != key]
+    if mode == "merge" and table == "Impression":
+        assignments = []
+        for c in updates:
+            if c == "dialogue_count":
+                assignments.append(
+                    "dialogue_count = COALESCE(Impression.dialogue_count, 0) "
+                    "+ COALESCE(excluded.dialogue_count, 0)"
+                )
+            else:
+                assignments.append(f"{c} = COALESCE(Impression.{c}, excluded.{c})")
+        return sql + f" ON CONFLICT({key}) DO UPDATE SET {', '.join(assignments)}"
+
+    assignments = ", ".join(f"{c} = excluded.{c}" for c in updates)
+    sql += f" ON CONFLICT({key}) DO UPDATE SET {assignments}"
+    if mode == "merge" and table == "dynamic_personas":
+        sql += " WHERE excluded.updated_at > dynamic_personas.updated_at"
+    return sql
+
+
+def _skipped_columns(table):
+    """导入时不写入的列：由目标库重新分配的主键，或与新 id 对不上的水位"""
+    if table in ("dynamic_personas", "Message"):
+        return {"id"}
+    if table == "Impression":
+        return {"last_summarized_message_id"}
+    return set()
+
+
+def _stored_messages(conn, qq_number, chat_times, speakers):
+    """目标库中该用户在这些时间的聊天记录 (chat_time, 整段文本)，紧凑格式还原后返回"""
+    marks = ", ".join("?" for _ in chat_times)
+    where = f"WHERE qq_number = ? AND chat_time IN ({marks})"
+    params = (qq_number, *chat_times)
+    if speakers is None:
+        for chat_time, message in conn.execute(
+            f"SELECT chat_time, message FROM Message {where}", params
+        ):
+            yield chat_time, message
+        return
+    sql = f"SELECT chat_time, message, {', '.join(COMPACT_COLUMNS)} FROM Message {where}"
+    for row in conn.execute(sql, params):
+        record = dict(zip(("chat_time", "message", *COMPACT_COLUMNS), row))
+        yield record["chat_time"], _legacy_message(record, speakers)["message"]
+
+
+def _new_messages(conn, columns, rows, compact):
+    """去掉目标库中(以及本批次内)已存在的聊天记录"""
+    if not set(MESSAGE_KEY) <= set(columns):
+        return rows
+    positions = [columns.index(c) for c in MESSAGE_KEY]
+    wanted = {}  # qq_number -> 本批次出现的 chat_time
+    for row in rows:
+        wanted.setdefault(row[positions[0]], set()).add(row[positions[1]])
+
+    speakers = _speakers(conn) if compact else None
+    existing = set()
+    for qq_number, chat_times in wanted.items():
+        chat_times = [t for t in chat_times if t is not None]
+        if not chat_times:
+            continue
+        for chat_time, message in _stored_messages(conn, qq_number, chat_times, speakers):
+            existing.add((qq_number, chat_time, message))
+
+    fresh = []
+    for row in rows:
+        key = tuple(row[p] for p in positions)
+        if key not in existing:
+            existing.add(key)
+            fresh.append(row)
+    return fresh
+
+
+def import_memories(db_path, in_path, mode="skip", chunk_size=1000, pause=0.0):
+    """从 JSONL 导入，每 chunk_size 行一个事务；返回各表读取的行数"""
+    if mode not in MODES:
+        raise ValueError(f"未知的冲突处理方式: {mode}，可选 {', '.join(MODES)}")
+
+    if not os.path.isfile(db_path):
+        raise ValueError(f"目标数据库 {db_path} 不存在，请先启动一次插件完成建表")
+
+    counts = {table: 0 for table in TABLES}
+    conn = connect(db_path)
+    # (表, 列元组) -> 待写入的行
+    batches = {}
+    pending = 0
+
+    def flush():
+        nonlocal pending
+        if not pending:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for (table, columns), rows in batches.items():
+                if table == "Message":
+                    rows = _new_messages(conn, columns, rows, compact)
+                conn.executemany(_insert_sql(table, columns, mode), rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        batches.clear()
+        pending = 0
+        if pause:
+            # 让出写锁，插件的写入可以插在两个事务之间
+            time.sleep(pause)
+
+    try:
+        target_columns = {table: _table_columns(conn, table) for table in TABLES}
+        # 目标库有紧凑格式的列时，判重需要把已有记录还原成整段文本
+        compact = set(COMPACT_COLUMNS) <= set(target_columns["Message"])
+        with _open_text(in_path, "r") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("format") != FORMAT_NAME:
+                raise ValueError("不是 PersonaFlow 导出文件")
+            if header.get("version", 0) > FORMAT_VERSION:
+                raise ValueError(f"导出文件版本 {header.get('version')} 过新，请升级插件")
+
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                table = item.get("table")
+                if table not in TABLES:
+                    continue
+                skipped = _skipped_columns(table)
+                # 只写入目标库中存在的列，兼容不同版本的表结构
+                columns = tuple(
+                    c for c in target_columns[table] if c in item["row"] and c not in skipped
+                )
+                row = tuple(_decode(item["row"][c]) for c in columns)
+                batches.setdefault((table, columns), []).append(row)
+                counts[table] += 1
+                pending += 1
+                if pending >= chunk_size:
+                    flush()
+            flush()
+    finally:
+        conn.close()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PersonaFlow 记忆导出/导入")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = sub.add_parser("export", help="导出数据库到 JSONL(.gz)")
+    export_parser.add_argument("db", help="OSNpermemory.db 路径")
+    export_parser.add_argument("output", help="输出文件，以 .gz 结尾时压缩")
+
+    import_parser = sub.add_parser("import", help="从 JSONL(.gz) 导入数据库")
+    import_parser.add_argument("db", help="OSNpermemory.db 路径")
+    import_parser.add_argument("input", help="导出文件")
+    import_parser.add_argument("--mode", choices=MODES, default="skip", help="冲突处理方式")
+    import_parser.add_argument("--pause-ms", type=int, default=0,
+                               help="每个事务之间的停顿(毫秒)，机器人运行时导入可适当调大")
+
+    for p in (export_parser, import_parser):
+        p.add_argument("--chunk-size", type=int, default=1000, help="每块行数")
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        counts = export_memories(args.db, args.output, args.chunk_size)
+    else:
+        counts = import_memories(
+            args.db, args.input, args.mode, args.chunk_size, args.pause_ms / 1000
+        )
+    print(json.dumps(counts, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
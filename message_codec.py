@@ -0,0 +1,103 @@
+"""
+PersonaFlow 聊天记录的紧凑存储格式
+
+旧格式在 Message.message 中保存合并后的整段文本:
+    用户名: "用户消息" 人格名: "AI 回复"
+紧凑格式把用户消息、AI 回复分列保存，说话人(用户昵称、人格名)存为 Speaker 表的 id，
+超过阈值的正文压缩后以 BLOB 保存；读取时再按需拼回旧格式，两种格式可以在同一张表里共存。
+
+压缩后的 BLOB 第一个字节标记编码方式: z = zlib，s = zstd。
+zstd 优先使用标准库 compression.zstd(Python 3.14+)，其次是可选依赖 zstandard，都没有时只能用 zlib。
+"""
+
+import zlib
+
+try:
+    from compression import zstd as _zstd
+
+    def _zstd_compress(data):
+        return _zstd.compress(data)
+
+    def _zstd_decompress(data):
+        return _zstd.decompress(data)
+
+except ImportError:
+    try:
+        import zstandard as _zstd
+
+        def _zstd_compress(data):
+            return _zstd.ZstdCompressor().compress(data)
+
+        def _zstd_decompress(data):
+            return _zstd.ZstdDecompressor().decompress(data)
+
+    except ImportError:
+        _zstd = None
+
+ZSTD_AVAILABLE = _zstd is not None
+CODECS = ("zlib", "zstd")
+
+_MARKERS = {"zlib": b"z", "zstd": b"s"}
+
+
+def merge_message(user_name, user_text, ai_name, ai_text):
+    """拼出旧格式的整段聊天记录(与紧凑存储之前 Message.message 列的格式逐字节一致)"""
+    return f'{user_name}: "{user_text}" {ai_name}: "{ai_text}"'.strip()
+
+
+def split_message(message, ai_names):
+    """把旧格式的聊天记录拆回 (用户名, 用户消息, 人格名, AI 回复)，拆不开时返回 None
+
+    只接受能原样拼回的拆分结果，所以迁移不会改变任何一条记录的内容
+    """
+    if not message or not message.endswith('"'):
+        return None
+    head = message.find(': "')
+    if head < 0:
+        return None
+    user_name, body = message[:head], message[head + 3 : -1]
+    for ai_name in ai_names:
+        sep = f'" {ai_name}: "'
+        pos = body.find(sep)
+        while pos >= 0:
+            user_text, ai_text = body[:pos], body[pos + len(sep) :]
+            if merge_message(user_name, user_text, ai_name, ai_text) == message:
+                return user_name, user_text, ai_name, ai_text
+            pos = body.find(sep, pos + 1)
+    return None
+
+
+def encode_body(text, threshold, codec="zlib"):
+    """UTF-8 长度达到 threshold 字节的正文压缩为 BLOB，否则(或压缩后不更小)原样保存"""
+    if text is None or threshold <= 0:
+        return text
+    raw = text.encode("utf-8")
+    if len(raw) < threshold:
+        return text
+    if codec == "zstd" and ZSTD_AVAILABLE:
+        packed = _MARKERS["zstd"] + _zstd_compress(raw)
+    else:
+        packed = _MARKERS["zlib"] + zlib.compress(raw)
+    return packed if len(packed) < len(raw) else text
+
+
+def decode_body(value):
+    """encode_body 的逆操作，TEXT 原样返回"""
+    if not isinstance(value, bytes | bytearray | memoryview):
+        return value
+    value = bytes(value)
+    marker, payload = value[:1], value[1:]
+    if marker == _MARKERS["zlib"]:
+        return zlib.decompress(payload).decode("utf-8")
+    if marker == _MARKERS["zstd"]:
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("聊天记录使用 zstd 压缩，但当前环境没有 zstd 支持")
+        return _zstd_decompress(payload).decode("utf-8")
+    raise ValueError(f"未知的聊天记录编码: {marker!r}")
+
+
+def decode_message(message, user_text, ai_text, user_name, ai_name):
+    """旧格式直接返回 message，紧凑格式解压后拼回整段文本"""
+    if message is not None:
+        return message
+    return merge_message(user_name, decode_body(user_text), ai_name, decode_body(ai_text))